@@ -0,0 +1,155 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Compare separate and shared thread pools for asyncio plus a Trio guest
+
+Both sides send the same mixed blocking job to threads at the same time:
+asyncio coroutines with loop.run_in_executor(None, ...), and Trio guest tasks
+with shared_executor.to_thread, like FileSink and offload do. Each job sleeps
+(standing in for blocking I/O) and then spins on the CPU while holding the GIL.
+
+- separate: asyncio's default executor plus Trio's thread cache (to_thread's
+  fallback), each with its default limit
+- shared N: one MeteredExecutor with N workers runs the jobs from both sides
+
+For each we report jobs/s, the most threads alive at once, the p99 lateness
+of a 5 ms asyncio ticker (a proxy for how a GUI loop would feel), and for the
+shared pools the utilization and deepest queue. Each pool runs in a fresh
+process, so idle threads left over from one don't count against the next.
+
+Usage: python bench_executor.py [jobs_per_side] [concurrency]
+"""
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import trio
+
+import example_tasks
+import shared_executor
+from latency_recorder import percentile
+from trio_guest_asyncio import AioHost, ticker
+
+
+def job(io_time=0.002, cpu_time=0.0005):
+    time.sleep(io_time)
+    end = time.perf_counter() + cpu_time
+    while time.perf_counter() < end:
+        pass
+
+
+async def trio_side(display, jobs, concurrency):
+    remaining = jobs
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await shared_executor.to_thread(job)
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(concurrency):
+            nursery.start_soon(worker)
+
+
+async def asyncio_side(jobs, concurrency):
+    loop = asyncio.get_running_loop()
+    remaining = jobs
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await loop.run_in_executor(None, job)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def measure(jobs, concurrency, max_workers):
+    loop = asyncio.get_running_loop()
+    executor = None if max_workers is None else shared_executor.MeteredExecutor(max_workers)
+    host = AioHost(loop, executor)
+    lateness, threads = [], []
+    stopped = asyncio.Event()
+    monitor_task = asyncio.create_task(
+        ticker(0.005, lateness, stopped, lambda: threads.append(threading.active_count()))
+    )
+    start = time.perf_counter()
+    trio.lowlevel.start_guest_run(
+        shared_executor.run_guest,
+        trio_side,
+        example_tasks.NullDisplay(),
+        jobs,
+        concurrency,
+        run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+        run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+        done_callback=host.done_callback,
+        host_uses_signal_set_wakeup_fd=True,
+    )
+    await asyncio_side(jobs, concurrency)
+    (await host.done_fut).unwrap()
+    dur = time.perf_counter() - start
+    stopped.set()
+    await monitor_task
+    metrics = executor.metrics() if executor is not None else None
+    lateness.sort()
+    return {
+        "jobs_per_sec": 2 * jobs / dur,
+        "max_threads": max(threads),
+        "p50_ms": percentile(lateness, 50) * 1000,
+        "p99_ms": percentile(lateness, 99) * 1000,
+        "metrics": metrics,
+    }
+
+
+def run_in_subprocess(jobs, concurrency, max_workers):
+    proc = subprocess.run(
+        [sys.executable, __file__, "--child", str(jobs), str(concurrency), json.dumps(max_workers)],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def main(jobs=2000, concurrency=32):
+    jobs, concurrency = int(jobs), int(concurrency)
+    print(
+        f"{'pool':10} {'jobs/s':>8} {'threads':>8} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'util':>6} {'max q':>6}"
+    )
+    for label, max_workers in (("separate", None), ("shared 4", 4), ("shared 8", 8), ("shared 16", 16)):
+        result = run_in_subprocess(jobs, concurrency, max_workers)
+        metrics = result["metrics"]
+        extra = (
+            f" {metrics['utilization']:6.1%} {metrics['max_queue_depth']:6}"
+            if metrics is not None
+            else f" {'':>6} {'':>6}"
+        )
+        print(
+            f"{label:10} {result['jobs_per_sec']:8.0f} {result['max_threads']:8}"
+            f" {result['p50_ms']:8.3f} {result['p99_ms']:8.3f}" + extra
+        )
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--child"]:
+        jobs, concurrency, max_workers = int(sys.argv[2]), int(sys.argv[3]), json.loads(sys.argv[4])
+        print(json.dumps(asyncio.run(measure(jobs, concurrency, max_workers))))
+    else:
+        main(*sys.argv[1:3])
@@ -0,0 +1,75 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Compare per-request and pooled clients for many small fetches
+
+Runs example_tasks.fetch_many against a local http_standin server for n URLs
+of size bytes each:
+
+- per-request: a fresh httpx.AsyncClient for every URL
+- pooled: one client with keep-alive, up to 10 connections
+- pooled 1 conn: one client, one keep-alive connection
+- http2: one client, HTTP/2 with prior knowledge, so every request is
+  multiplexed over one connection (skipped without the h2 package)
+
+All modes keep 10 requests in flight. We report requests/sec and CPU
+milliseconds per request. The CPU time includes the stand-in server, which
+runs in a thread of this process.
+
+Usage: python bench_fetch.py [n] [size]
+"""
+import sys
+import time
+from functools import partial
+
+import trio
+
+import example_tasks
+import http_standin
+
+
+MODES = {
+    "per-request": dict(pooled=False),
+    "pooled": dict(),
+    "pooled 1 conn": dict(max_connections=1, concurrency=10),
+    "http2": dict(http2=True, http1=False, concurrency=10),
+}
+
+
+def main(n=2000, size=1000):
+    n, size = int(n), int(size)
+    try:
+        import h2
+    except ImportError:
+        h2 = None
+    print(f"{'mode':14} {'req/s':>8} {'cpu ms/req':>11}")
+    with http_standin.standin_server() as base_url:
+        urls = [f"{base_url}/bytes/{size}"] * n
+        for mode, kwargs in MODES.items():
+            if mode == "http2" and h2 is None:
+                print(f"{mode:14} skipped (no h2 package)")
+                continue
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            ok = trio.run(partial(example_tasks.fetch_many, example_tasks.NullDisplay(), urls, **kwargs))
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if ok != n:
+                raise RuntimeError(f"{mode}: only {ok} of {n} requests succeeded")
+            print(f"{mode:14} {n / wall:8.0f} {cpu / n * 1000:11.3f}")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
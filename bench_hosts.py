@@ -0,0 +1,607 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Run the same benchmark task on every host that works on this machine
+
+Each host runs in its own subprocess through its module's main(task), with
+whatever environment it needs to work headless. Hosts whose toolkit isn't
+installed are reported as skipped rather than failing the run.
+
+Modes:
+
+- latency: runs example_tasks.check_latency and reports the min/p50/p90/p99/max
+  lateness of its wakeups.
+- throughput: runs example_tasks.spin then example_tasks.ping_pong and reports
+  ticks/sec and thread round trips/sec, plus how many host calls went through
+  run_sync_soon_threadsafe versus run_sync_soon_not_threadsafe in each phase.
+  Hosts without a not-threadsafe method get all calls on the threadsafe path.
+  The tkinter-after-idle and tkinter-after-idle-0 rows schedule both paths with
+  "after idle" or with "after idle after 0", to see what the incantation costs,
+  and the qt5-signal row reenters Qt through a queued signal instead of a
+  posted event.
+- alloc: runs example_tasks.spin under tracemalloc and reports, per guest
+  tick, the peak traced memory above the tick's starting point and the bytes
+  and blocks still retained afterwards. Then runs a long example_tasks.count
+  and reports its peak and retained memory. --max-bytes-per-tick sets a hard
+  limit on the per-tick peak.
+- download: runs example_tasks.get against a local http_standin server for
+  each read size in a sweep, and reports MB/s and CPU seconds per MB.
+  --connections N uses get's parallel ranged mode, and --to-disk writes the
+  body to a temporary file through get's FileSink. A body written to disk is
+  checked byte for byte against the stand-in's payload.
+  --check instead downloads to disk once per host in each of three ways, and
+  exits with status 1 unless every body matches: 4 parallel ranges, 4
+  connections asked of a server that won't serve ranges (?ranges=0, so get
+  falls back to one stream), and one stream that the server keeps dropping
+  (?fail_after=, so get resumes with Range requests).
+
+--threadless on runs the hosts that support it with trio_threadless, and
+--threadless both runs them both ways so the two paths can be compared.
+
+Usage:
+
+    python bench_hosts.py [--mode {latency,throughput,download,alloc}] [--hosts asyncio,qt5]
+                          [--threadless {off,on,both}]
+                          [--json out.json] [--markdown out.md]
+                          [--baseline baseline.json] [--save-baseline baseline.json]
+
+A --baseline saved from a different mode or with different parameters is refused.
+
+Exits with status 1 if any host regressed against the baseline, went over
+--max-bytes-per-tick, or failed a --check download.
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+HOSTS = {
+    "asyncio": dict(module="trio_guest_asyncio", host_class="AioHost", threadless=True),
+    "tornado": dict(module="trio_guest_tornado", host_class="TornadoHost"),
+    "tkinter": dict(
+        module="trio_guest_tkinter", host_class="TkHost", needs_x=True, threadless=True
+    ),
+    "qt5": dict(
+        module="trio_guest_qt5",
+        host_class="QtHost",
+        env={"QT_QPA_PLATFORM": "offscreen"},
+        threadless=True,
+    ),
+    # the same hosts scheduling a different way, to compare against the rows above
+    "tkinter-after-idle": dict(
+        module="trio_guest_tkinter",
+        host_class="TkHost",
+        main_kwargs={"after": "idle"},
+        needs_x=True,
+        threadless=True,
+    ),
+    "tkinter-after-idle-0": dict(
+        module="trio_guest_tkinter",
+        host_class="TkHost",
+        main_kwargs={"after": "idle after 0"},
+        needs_x=True,
+        threadless=True,
+    ),
+    "qt5-signal": dict(
+        module="trio_guest_qt5",
+        host_class="QtSignalHost",
+        main_kwargs={"signal": True},
+        env={"QT_QPA_PLATFORM": "offscreen"},
+        threadless=True,
+    ),
+    "pygame": dict(
+        module="trio_guest_pygame", host_class="PygameHost", env={"SDL_VIDEODRIVER": "dummy"}
+    ),
+    "gtk": dict(module="trio_guest_gtk", host_class="GtkHost", needs_x=True, threadless=True),
+}
+
+# Metrics compared against the baseline, with +1 if higher is better, -1 if lower is better
+REGRESSION_METRICS = {
+    "latency": {"p50": -1, "p99": -1},
+    "throughput": {"ticks_per_sec": +1, "pongs_per_sec": +1},
+    "download": {"MB_per_sec": +1, "cpu_s_per_MB": -1},
+    "alloc": {"peak_B_per_tick": -1, "retained_B_per_tick": -1},
+}
+
+# Table columns per mode, with a format for each
+COLUMNS = {
+    "latency": {
+        "n": "{}".format,
+        "min": "{:.3f} ms".format,
+        "p50": "{:.3f} ms".format,
+        "p90": "{:.3f} ms".format,
+        "p99": "{:.3f} ms".format,
+        "max": "{:.3f} ms".format,
+    },
+    "throughput": {
+        "ticks_per_sec": "{:.0f}".format,
+        "spin_threadsafe": "{}".format,
+        "spin_not_threadsafe": "{}".format,
+        "pongs_per_sec": "{:.0f}".format,
+        "pong_threadsafe": "{}".format,
+        "pong_not_threadsafe": "{}".format,
+    },
+    "download": {
+        "MB_per_sec": "{:.1f}".format,
+        "cpu_s_per_MB": "{:.4f}".format,
+    },
+    "alloc": {
+        "ticks": "{}".format,
+        "peak_B_per_tick": "{:.0f}".format,
+        "retained_B_per_tick": "{:.1f}".format,
+        "retained_blocks_per_tick": "{:.3f}".format,
+        "count_peak_KB": "{:.1f}".format,
+        "count_retained_KB": "{:.1f}".format,
+    },
+}
+# Ignore regressions smaller than this, in the metric's own units
+DEFAULT_FLOOR = {"latency": 0.0005, "alloc": 64}
+# latencies are stored in seconds but shown in milliseconds
+SCALE = {"latency": {key: 1000 for key in ("min", "p50", "p90", "p99", "max")}}
+
+
+##########################################
+### Child side: runs inside the host   ###
+##########################################
+
+
+def _child_latency(main, host_cls, period, duration):
+    import example_tasks
+    from latency_recorder import LatencyRecorder
+
+    recorder = LatencyRecorder()
+    main(partial(example_tasks.check_latency, period=period, duration=duration, recorder=recorder))
+    return recorder.summary()
+
+
+def _count_host_calls(host_cls):
+    """Patch host_cls so calls to its run_sync_soon_* methods are counted"""
+    counts = dict.fromkeys(("run_sync_soon_threadsafe", "run_sync_soon_not_threadsafe"), 0)
+    for name in counts:
+        method = getattr(host_cls, name, None)
+        if method is None:
+            continue
+
+        def counted(self, func, _method=method, _name=name):
+            counts[_name] += 1
+            return _method(self, func)
+
+        setattr(host_cls, name, counted)
+    return counts
+
+
+def _child_throughput(main, host_cls, ntasks, duration):
+    import example_tasks
+
+    counts = _count_host_calls(host_cls)
+    result = {}
+
+    def take_counts(prefix):
+        result[prefix + "_threadsafe"] = counts["run_sync_soon_threadsafe"]
+        result[prefix + "_not_threadsafe"] = counts["run_sync_soon_not_threadsafe"]
+        for name in counts:
+            counts[name] = 0
+
+    async def both(display):
+        take_counts("startup")
+        result["ticks_per_sec"] = await example_tasks.spin(display, ntasks, duration)
+        take_counts("spin")
+        result["pongs_per_sec"] = await example_tasks.ping_pong(display, duration)
+        take_counts("pong")
+
+    main(both)
+    return result
+
+
+def _child_download(main, host_cls, url, size, read_size, connections, to_disk):
+    import example_tasks
+
+    result = {}
+
+    async def timed_get(display, dest):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if not await example_tasks.get(
+            display,
+            url=url,
+            size_guess=size,
+            read_size=read_size,
+            connections=connections,
+            dest=dest,
+        ):
+            raise RuntimeError("download failed")
+        megabytes = size / 1e6
+        result["MB_per_sec"] = megabytes / (time.perf_counter() - wall)
+        result["cpu_s_per_MB"] = (time.process_time() - cpu) / megabytes
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "download.bin") if to_disk else None
+        main(partial(timed_get, dest=dest))
+        if dest is not None and not _matches_payload(dest, size):
+            raise RuntimeError(f"{dest} doesn't match the stand-in payload")
+    return result
+
+
+def _matches_payload(path, size):
+    import http_standin
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size != size:
+            return False
+        return all(f.read(len(piece)) == piece for piece in http_standin.payload(0, size))
+
+
+def _trace_host_thunks(host_cls):
+    """Patch host_cls so each thunk it runs records its peak traced memory
+
+    Returns a dict of the number of thunks run and the sum of how far traced
+    memory rose above where it started during each one. The partial wrapping
+    each thunk is allocated by whoever scheduled it, usually the previous thunk,
+    so its size is measured here and subtracted from every thunk.
+    """
+    import tracemalloc
+
+    get_traced_memory = tracemalloc.get_traced_memory
+    reset_peak = tracemalloc.reset_peak
+    stats = {"thunks": 0, "peak_bytes": 0}
+
+    def traced(func):
+        start = get_traced_memory()[0]
+        reset_peak()
+        try:
+            func()
+        finally:
+            stats["peak_bytes"] += get_traced_memory()[1] - start - overhead
+            stats["thunks"] += 1
+
+    before = get_traced_memory()[0]
+    wrapper = partial(traced, int)
+    overhead = get_traced_memory()[0] - before
+    del wrapper
+
+    for name in ("run_sync_soon_threadsafe", "run_sync_soon_not_threadsafe"):
+        method = getattr(host_cls, name, None)
+        if method is None:
+            continue
+
+        def wrapped(self, func, _method=method):
+            return _method(self, partial(traced, func))
+
+        setattr(host_cls, name, wrapped)
+    return stats
+
+
+def _traced_total(snapshot):
+    size = count = 0
+    for stat in snapshot.statistics("filename"):
+        size += stat.size
+        count += stat.count
+    return size, count
+
+
+def _child_alloc(main, host_cls, ntasks, duration, count_period):
+    import tracemalloc
+
+    import example_tasks
+
+    tracemalloc.start()
+    stats = _trace_host_thunks(host_cls)
+    result = {}
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+
+    def take_snapshot():
+        return _traced_total(tracemalloc.take_snapshot().filter_traces(ignore))
+
+    async def phases(display):
+        # warm up caches, free lists and Trio's own structures first
+        await example_tasks.spin(display, ntasks, min(0.5, duration))
+        size, blocks = take_snapshot()
+        stats.update(thunks=0, peak_bytes=0)
+        await example_tasks.spin(display, ntasks, duration)
+        ticks = stats["thunks"]
+        new_size, new_blocks = take_snapshot()
+        result["ticks"] = ticks
+        result["peak_B_per_tick"] = stats["peak_bytes"] / ticks
+        result["retained_B_per_tick"] = (new_size - size) / ticks
+        result["retained_blocks_per_tick"] = (new_blocks - blocks) / ticks
+
+        size, _ = take_snapshot()
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        await example_tasks.count(display, period=count_period, max=int(duration / count_period))
+        result["count_peak_KB"] = (tracemalloc.get_traced_memory()[1] - start) / 1024
+        result["count_retained_KB"] = (take_snapshot()[0] - size) / 1024
+
+    main(phases)
+    tracemalloc.stop()
+    return result
+
+
+CHILD_MODES = {
+    "latency": _child_latency,
+    "throughput": _child_throughput,
+    "download": _child_download,
+    "alloc": _child_alloc,
+}
+
+
+def child(host, mode, params, result_path):
+    import importlib
+
+    spec = HOSTS[host]
+    module = importlib.import_module(spec["module"])
+    main = partial(module.main, **spec.get("main_kwargs", {}))
+    if params.pop("threadless", False):
+        main = partial(main, threadless=True)
+    result = CHILD_MODES[mode](main, getattr(module, spec["host_class"]), **params)
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+##########################################
+### Parent side: launch and report     ###
+##########################################
+
+
+def run_host(host, mode, params, timeout):
+    spec = HOSTS[host]
+    if params.get("threadless") and not spec.get("threadless"):
+        return {"status": "skipped", "reason": "no threadless support"}
+    env = dict(os.environ, **spec.get("env", {}))
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", host, mode, json.dumps(params)]
+    if spec.get("needs_x") and sys.platform.startswith("linux") and not env.get("DISPLAY"):
+        xvfb_run = shutil.which("xvfb-run")
+        if xvfb_run is None:
+            return {"status": "skipped", "reason": "no DISPLAY and xvfb-run not found"}
+        cmd = [xvfb_run, "-a"] + cmd
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, "result.json")
+        try:
+            proc = subprocess.run(
+                cmd + [result_path],
+                env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return {"status": "error", "reason": f"timed out after {timeout} s"}
+        if proc.returncode == 0 and os.path.exists(result_path):
+            with open(result_path) as f:
+                return {"status": "ok", **json.load(f)}
+    last_line = proc.stderr.strip().splitlines()[-1:] or [f"exit status {proc.returncode}"]
+    if "ModuleNotFoundError" in proc.stderr or "ImportError" in proc.stderr:
+        return {"status": "skipped", "reason": last_line[0]}
+    return {"status": "error", "reason": last_line[0]}
+
+
+def baseline_mismatch(baseline, mode, params):
+    """Why baseline can't be compared with a run of mode with params, or None
+
+    The stand-in server's URL is left out, since its port changes every run.
+    """
+    if baseline.get("mode") != mode:
+        return f"is for mode {baseline.get('mode')!r}, not {mode!r}"
+    old_params = {k: v for k, v in baseline.get("params", {}).items() if k != "url"}
+    new_params = {k: v for k, v in params.items() if k != "url"}
+    if old_params != new_params:
+        return f"was run with {old_params}, not {new_params}"
+    return None
+
+
+def find_regressions(results, baseline, mode, tolerance, floor):
+    """Compare against a stored baseline
+
+    A metric regresses if it got worse by more than tolerance (relative)
+    AND by more than floor (absolute, in the metric's own units).
+    """
+    regressions = []
+    for host, result in results.items():
+        old = baseline.get(host)
+        if result.get("status") != "ok" or not old or old.get("status") != "ok":
+            continue
+        for metric, sign in REGRESSION_METRICS[mode].items():
+            if metric not in result or metric not in old:
+                continue
+            # flip the sign so that bigger is always worse
+            new_value, old_value = -sign * result[metric], -sign * old[metric]
+            if new_value > old_value + abs(old_value) * tolerance and new_value - old_value > floor:
+                regressions.append(
+                    f"{host} {metric}: {abs(old_value):.6g} -> {abs(new_value):.6g}"
+                )
+    return regressions
+
+
+def markdown_table(results, mode):
+    columns = COLUMNS[mode]
+    scale = SCALE.get(mode, {})
+    lines = [
+        f"| host | status | {' | '.join(columns)} |",
+        "|---" * (len(columns) + 2) + "|",
+    ]
+    for host, result in results.items():
+        if result["status"] == "ok":
+            cells = [
+                fmt(result[column] * scale.get(column, 1)) for column, fmt in columns.items()
+            ]
+        else:
+            cells = [result["reason"]] + [""] * (len(columns) - 1)
+        lines.append(f"| {host} | {result['status']} | {' | '.join(cells)} |")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=CHILD_MODES, default="latency")
+    parser.add_argument("--hosts", default=",".join(HOSTS), help="comma separated subset of hosts")
+    parser.add_argument("--threadless", choices=("off", "on", "both"), default="off")
+    parser.add_argument("--period", type=float, default=0.01, help="latency sampling period (s)")
+    parser.add_argument(
+        "--ntasks", type=int, default=10, help="spinning tasks for throughput and alloc"
+    )
+    parser.add_argument(
+        "--count-period", type=float, default=0.001, help="count period for alloc's long run (s)"
+    )
+    parser.add_argument(
+        "--max-bytes-per-tick",
+        type=float,
+        help="fail if any host's alloc peak_B_per_tick is above this",
+    )
+    parser.add_argument("--size", type=int, default=100_000_000, help="download size in bytes")
+    parser.add_argument(
+        "--read-sizes", default="4096,65536,262144,1048576", help="comma separated sweep"
+    )
+    parser.add_argument("--connections", type=int, default=1, help="parallel ranges for download")
+    parser.add_argument("--to-disk", action="store_true", help="write downloads to a temp file")
+    parser.add_argument(
+        "--check", action="store_true", help="check ranged, fallback and resumed downloads"
+    )
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per host")
+    parser.add_argument("--timeout", type=float, default=60.0, help="kill a host after this long")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--markdown", help="write the table to this markdown file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--save-baseline", help="write results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative slack for regressions")
+    parser.add_argument(
+        "--floor", type=float, help="absolute slack for regressions, in the metric's units"
+    )
+    args = parser.parse_args(argv)
+
+    mode = args.mode
+    hosts = args.hosts.split(",")
+    with contextlib.ExitStack() as stack:
+        if mode == "latency":
+            params = {"period": args.period, "duration": args.duration}
+            runs = [(host, host, params) for host in hosts]
+        elif mode == "throughput":
+            params = {"ntasks": args.ntasks, "duration": args.duration}
+            runs = [(host, host, params) for host in hosts]
+        elif mode == "alloc":
+            params = {
+                "ntasks": args.ntasks,
+                "duration": args.duration,
+                "count_period": args.count_period,
+            }
+            runs = [(host, host, params) for host in hosts]
+        else:
+            import http_standin
+
+            base_url = stack.enter_context(http_standin.standin_server())
+            params = {
+                "url": f"{base_url}/bytes/{args.size}",
+                "size": args.size,
+                "connections": args.connections,
+                "to_disk": args.to_disk,
+            }
+            if args.check:
+                checks = [
+                    ("ranged", "", 4),
+                    ("ranges=0", "?ranges=0", 4),
+                    ("fail_after", f"?fail_after={args.size // 4 + 1}", 1),
+                ]
+                runs = [
+                    (
+                        f"{host} check {name}",
+                        host,
+                        dict(
+                            params,
+                            url=params["url"] + query,
+                            connections=connections,
+                            to_disk=True,
+                            read_size=65536,
+                        ),
+                    )
+                    for host in hosts
+                    for name, query, connections in checks
+                ]
+            else:
+                runs = [
+                    (
+                        f"{host} read={read_size} connections={args.connections}"
+                        + " to_disk" * args.to_disk,
+                        host,
+                        dict(params, read_size=int(read_size)),
+                    )
+                    for host in hosts
+                    for read_size in args.read_sizes.split(",")
+                ]
+        if args.threadless != "off":
+            variants = [
+                (row + " threadless", host, dict(run_params, threadless=True))
+                for row, host, run_params in runs
+            ]
+            if args.threadless == "on":
+                runs = variants
+            else:
+                runs = [run for pair in zip(runs, variants) for run in pair]
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            mismatch = baseline_mismatch(baseline, mode, params)
+            if mismatch:
+                parser.error(f"baseline {args.baseline} {mismatch}")
+        results = {}
+        for row, host, run_params in runs:
+            print(f"{row}...", file=sys.stderr, flush=True)
+            results[row] = run_host(host, mode, run_params, args.timeout)
+
+    report = {"mode": mode, "params": params, "results": results}
+    table = markdown_table(results, mode)
+    print(table)
+    if args.markdown:
+        with open(args.markdown, "w") as f:
+            f.write(table + "\n")
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    failed = False
+    if mode == "alloc" and args.max_bytes_per_tick is not None:
+        for row, result in results.items():
+            if result["status"] == "ok" and result["peak_B_per_tick"] > args.max_bytes_per_tick:
+                print(
+                    f"OVER THRESHOLD {row}: {result['peak_B_per_tick']:.0f} B/tick"
+                    f" > {args.max_bytes_per_tick:g}"
+                )
+                failed = True
+    if mode == "download" and args.check:
+        for row, result in results.items():
+            if result["status"] == "error":
+                print(f"CHECK FAILED {row}: {result['reason']}")
+                failed = True
+    if args.baseline:
+        floor = DEFAULT_FLOOR.get(mode, 0) if args.floor is None else args.floor
+        regressions = find_regressions(results, baseline["results"], mode, args.tolerance, floor)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        failed |= bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], sys.argv[3], json.loads(sys.argv[4]), sys.argv[5])
+    else:
+        sys.exit(main())
@@ -0,0 +1,105 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Show that offloading chunk hashing keeps the host loop responsive
+
+Trio runs as a guest of asyncio, which stands in for a GUI loop. An asyncio
+callback ticks every period and records how late it runs while the guest
+downloads size bytes from http_standin and hashes them:
+
+- inline: example_tasks.sha256 with offload=False, hashing on the host thread
+- thread: example_tasks.sha256, hashing through an offload stage
+- process: a hash list (SHA-256 of each chunk's digest) computed in a
+  ProcessPoolExecutor through an offload stage, to exercise that path
+
+For each we report throughput and the p50, p99 and max tick lateness. Inline
+lateness grows with the read size; offloaded lateness shouldn't.
+
+Usage: python bench_offload.py [size] [read_size] [period]
+"""
+import asyncio
+import hashlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import httpx
+import trio
+
+import example_tasks
+import http_standin
+from latency_recorder import percentile
+from offload import open_offload
+from trio_guest_asyncio import AioHost, ticker
+
+
+def _chunk_digest(chunk):
+    return hashlib.sha256(chunk).digest()
+
+
+async def hash_list(display, url, executor, read_size):
+    example_tasks.set_read_size(read_size)
+    top = hashlib.sha256()
+    async with httpx.AsyncClient() as client, client.stream("GET", url) as response:
+        async with open_offload(_chunk_digest, top.update, executor=executor) as stage:
+            async for chunk in response.aiter_bytes():
+                await stage.send(chunk)
+    return top.hexdigest()
+
+
+async def measure(task, period):
+    loop = asyncio.get_running_loop()
+    host = AioHost(loop)
+    samples = []
+    stopped = asyncio.Event()
+    tick_task = asyncio.create_task(ticker(period, samples, stopped))
+    start = time.perf_counter()
+    trio.lowlevel.start_guest_run(
+        task,
+        example_tasks.NullDisplay(),
+        run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+        run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+        done_callback=host.done_callback,
+        host_uses_signal_set_wakeup_fd=True,
+    )
+    outcome = await host.done_fut
+    dur = time.perf_counter() - start
+    stopped.set()
+    await tick_task
+    return outcome.unwrap(), dur, sorted(samples)
+
+
+def main(size=256 << 20, read_size=1 << 20, period=0.005):
+    size, read_size = int(size), int(read_size)
+    expected = hashlib.sha256(http_standin.payload_bytes(size)).hexdigest()
+    print(f"{'mode':8} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    with http_standin.standin_server() as base_url, ProcessPoolExecutor() as executor:
+        url = f"{base_url}/bytes/{size}?chunk={read_size}"
+        for mode, task in (
+            ("inline", partial(example_tasks.sha256, url=url, expected=expected, offload=False, read_size=read_size)),
+            ("thread", partial(example_tasks.sha256, url=url, expected=expected, read_size=read_size)),
+            ("process", partial(hash_list, url=url, executor=executor, read_size=read_size)),
+        ):
+            result, dur, samples = asyncio.run(measure(task, period))
+            p50, p99 = percentile(samples, 50), percentile(samples, 99)
+            print(
+                f"{mode:8} {size / dur / 1e6:8.1f} {p50 * 1000:8.3f} "
+                f"{p99 * 1000:8.3f} {samples[-1] * 1000:8.3f}"
+            )
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:4]))
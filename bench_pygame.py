@@ -0,0 +1,156 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Compare PygameApp busy-polling and idle (blocking) main loops
+
+The guest mostly sleeps, like example_tasks.count, waking every period to
+update the display. The modes are:
+
+- spin: busy-polling with yield_gil=False, a pure spin that only lets the Trio
+  I/O thread have the GIL at the switch interval
+- busy: the default busy-polling loop, which yields the GIL with
+  time.sleep(0) every pass
+- idle: blocking in an SDL wait between batches of events
+
+For each mode we report CPU usage as a fraction of one
+core and the lateness of the wakeups. We also report the cost of a
+PygameDisplay.set_value call when many updates arrive within one frame, and
+flood PygameHost from several threads at once to check that every thunk runs.
+
+Usage: python bench_pygame.py [duration] [period]
+
+Uses the SDL dummy video driver unless SDL_VIDEODRIVER is already set.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import trio
+from outcome import Error
+
+from latency_recorder import percentile
+from trio_guest_pygame import PygameApp, PygameDisplay, PygameHost
+
+
+async def sleepy(display, period, duration):
+    samples = []
+    display.set_max(int(duration / period))
+    end = trio.current_time() + duration
+    while trio.current_time() < end:
+        target = trio.current_time() + period
+        await trio.sleep_until(target)
+        samples.append(trio.current_time() - target)
+        display.set_value(min(len(samples), display.maximum))
+    return samples
+
+
+def run(app_kwargs, period, duration):
+    app = PygameApp(**app_kwargs)
+    host = PygameHost(app)
+    display = PygameDisplay(app)
+    result = None
+
+    def done_callback(outcome):
+        nonlocal result
+        if isinstance(outcome, Error):
+            exc = outcome.error
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+        result = outcome.unwrap()
+        app.quit()
+
+    trio.lowlevel.start_guest_run(
+        sleepy,
+        display,
+        period,
+        duration,
+        run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+        run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+        done_callback=done_callback,
+    )
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    host.mainloop()
+    return (time.process_time() - cpu) / (time.perf_counter() - wall), sorted(result)
+
+
+def set_value_cost(n=100_000):
+    app = PygameApp()
+    display = PygameDisplay(app)
+    display.set_max(n)
+    start = time.perf_counter()
+    for i in range(n):
+        display.set_value(i)
+    dur = time.perf_counter() - start
+    pygame.quit()
+    return dur / n
+
+
+def stress(nthreads=8, per_thread=100_000):
+    app = PygameApp(idle=True)
+    host = PygameHost(app)
+    total = nthreads * per_thread
+    ran = 0
+
+    def thunk():
+        nonlocal ran
+        ran += 1
+        if ran == total:
+            app.quit()
+
+    def flood():
+        for _ in range(per_thread):
+            host.run_sync_soon_threadsafe(thunk)
+
+    threads = [threading.Thread(target=flood) for _ in range(nthreads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    host.mainloop()
+    dur = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    assert ran == total, (ran, total)
+    return total, dur
+
+
+MODES = {
+    "spin": dict(yield_gil=False),
+    "busy": dict(),
+    "idle": dict(idle=True),
+}
+
+
+def main(duration=2.0, period=0.05):
+    print(f"set_value: {set_value_cost() * 1e6:.2f} us/call")
+    total, dur = stress()
+    print(f"stress: {total} threadsafe thunks in {dur:.2f} s ({total / dur:.0f}/s)")
+    print(f"{'mode':6} {'cpu':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode, app_kwargs in MODES.items():
+        cpu, samples = run(app_kwargs, period, duration)
+        p50 = percentile(samples, 50)
+        p99 = percentile(samples, 99)
+        print(
+            f"{mode:6} {cpu:6.1%} "
+            f"{p50 * 1000:8.3f} {p99 * 1000:8.3f} {samples[-1] * 1000:8.3f}"
+        )
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:3]))
@@ -0,0 +1,164 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Measure the cold-start import cost of each module with python -X importtime
+
+Each module is imported in a fresh interpreter, repeats times. For each we
+report the median cumulative import time of the module itself, how much of that
+is over a bare `import trio` measured in the same run, the median wall time of
+the whole process, and the slowest imports it pulled in. Trio alone takes most
+of the time, so the budget applies to the time over Trio. A module also fails
+if it loads any of the lazily imported packages (httpx, httpcore, tqdm) just by
+being imported, or asyncio unless it is the asyncio or tornado host.
+
+Modules whose toolkit isn't installed are reported as skipped.
+
+Usage: python bench_startup.py [--budget MS] [--repeats N] [modules...]
+Exits with status 1 if any module fails.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+    "throttle",
+    "offload",
+    "dashboard",
+    "example_tasks",
+    "trio_guest_asyncio",
+    "trio_guest_tornado",
+    "trio_guest_tkinter",
+    "trio_guest_qt5",
+    "trio_guest_pygame",
+    "trio_guest_gtk",
+]
+LAZY = ("httpx", "httpcore", "tqdm")
+# Only these hosts may import asyncio; for the rest it is dead weight
+ASYNCIO_HOSTS = ("trio_guest_asyncio", "trio_guest_tornado")
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr):
+    """Map each imported module to (self, cumulative) microseconds"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        try:
+            times[name.strip()] = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue  # the header line
+    return times
+
+
+def forbidden(module):
+    """Packages that importing module must not load"""
+    return LAZY if module in ASYNCIO_HOSTS else LAZY + ("asyncio",)
+
+
+def import_once(module):
+    """Import module in a fresh interpreter
+
+    Returns (wall seconds, importtime dict, forbidden packages it loaded), or
+    None if the module (or its toolkit) can't be imported here.
+    """
+    code = (
+        f"import sys, {module}; "
+        f"print(' '.join(m for m in {forbidden(module)!r} if m in sys.modules))"
+    )
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", QT_QPA_PLATFORM="offscreen")
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=HERE,
+        env=env,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode:
+        if "ModuleNotFoundError" in proc.stderr or "ImportError" in proc.stderr:
+            return None
+        raise RuntimeError(f"importing {module} failed:\n{proc.stderr}")
+    # the last line, since some toolkits print a banner on import
+    loaded = proc.stdout.splitlines()[-1].split() if proc.stdout.strip() else []
+    return wall, parse_importtime(proc.stderr), loaded
+
+
+def measure(module, repeats):
+    # one untimed import first, so the baseline isn't paying for a cold disk cache
+    if import_once(module) is None:
+        return None
+    walls, cumulative = [], []
+    times = loaded = None
+    for _ in range(repeats):
+        result = import_once(module)
+        if result is None:
+            return None
+        wall, times, loaded = result
+        walls.append(wall)
+        cumulative.append(times[module][1])
+    slowest = sorted(
+        ((us, name) for name, (us, _) in times.items() if name != module), reverse=True
+    )[:3]
+    return {
+        "import_ms": statistics.median(cumulative) / 1000,
+        "wall_ms": statistics.median(walls) * 1000,
+        "slowest": [(name, us / 1000) for us, name in slowest],
+        "loaded": loaded,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument(
+        "--budget", type=float, default=50.0, help="import budget in ms over a bare import trio"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    trio_ms = measure("trio", args.repeats)["import_ms"]
+    failed = False
+    print(f"{'module':20} {'import ms':>10} {'over trio':>10} {'wall ms':>8}  slowest self times")
+    print(f"{'trio':20} {trio_ms:10.1f} {'':10} {'':8}  (baseline)")
+    for module in args.modules:
+        result = measure(module, args.repeats)
+        if result is None:
+            print(f"{module:20} skipped (not importable here)")
+            continue
+        over_trio = result["import_ms"] - trio_ms
+        problems = []
+        if over_trio > args.budget:
+            problems.append(f"over {args.budget:g} ms budget")
+        if result["loaded"]:
+            problems.append("loaded " + ", ".join(result["loaded"]))
+        failed |= bool(problems)
+        slowest = ", ".join(f"{name} {ms:.1f}" for name, ms in result["slowest"])
+        print(
+            f"{module:20} {result['import_ms']:10.1f} {over_trio:10.1f} "
+            f"{result['wall_ms']:8.1f}  {slowest}"
+        )
+        for problem in problems:
+            print(f"{'':20} FAIL: {problem}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
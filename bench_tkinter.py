@@ -0,0 +1,190 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Compare TkHost scheduling modes and policies
+
+Runs each workload once per mode on a withdrawn Tk root and prints a table:
+
+- ticks: example_tasks.spin, N tasks looping on trio.sleep(0)
+  (not-threadsafe path)
+- thread: example_tasks.ping_pong with trio.to_thread.run_sync (threadsafe
+  path)
+- latency: lateness of trio.sleep_until wakeups while the ticks workload runs
+- gui: the ticks workload again, while a Tk timer generates a <<Ping>> virtual
+  event every 5 ms whose handler does 1 ms of work, standing in for a user
+  interacting with a busy GUI. Reports guest ticks/s and how long each event
+  waited from being generated to its handler running.
+
+The modes are the unbatched host, then batched with each TkHost policy, then
+unbatched again with both paths scheduled by "after idle" (idle) and by
+"after idle after 0" (idle0), so the same workloads run both ways.
+
+Usage: python bench_tkinter.py [duration]
+
+Without a display this runs on a bare Tcl interpreter, which has the same event
+loop but no windows. There, each <<Ping>> is instead a byte written to a pipe
+whose file handler does the work, so it still waits behind queued guest ticks.
+"""
+import os
+import sys
+import time
+import tkinter as tk
+import traceback
+
+import trio
+from outcome import Error
+
+import example_tasks
+from latency_recorder import percentile
+from trio_guest_tkinter import TkHost
+
+
+async def lateness(period=0.01, duration=1.0):
+    samples = []
+
+    async def sampler():
+        while True:
+            target = trio.current_time() + period
+            await trio.sleep_until(target)
+            samples.append(trio.current_time() - target)
+
+    async with trio.open_nursery() as nursery:
+        nursery.cancel_scope.deadline = trio.current_time() + duration
+        nursery.start_soon(sampler)
+        nursery.start_soon(example_tasks.spin, example_tasks.NullDisplay(), 10, duration + 1)
+    return samples
+
+
+def make_root():
+    """Return (root, headless): a withdrawn Tk root, or a bare Tcl interpreter"""
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return tk.Tcl(), True
+    root.withdraw()
+    return root, False
+
+
+def is_headless(root):
+    return not root.tk.call('info', 'commands', 'winfo')
+
+
+async def gui_load(root, ntasks=10, duration=1.0, period=0.005, work=0.001):
+    samples = []
+    due = []
+    timer = None
+
+    def handler(event):
+        samples.append(time.perf_counter() - due.pop(0))
+        end = time.perf_counter() + work
+        while time.perf_counter() < end:
+            pass
+
+    if is_headless(root):
+        read_fd, write_fd = os.pipe()
+
+        def on_readable(file, mask):
+            os.read(read_fd, 1)
+            handler(None)
+
+        root.createfilehandler(read_fd, tk.READABLE, on_readable)
+        ping = lambda: os.write(write_fd, b"x")
+    else:
+        root.bind('<<Ping>>', handler)
+        ping = lambda: root.event_generate('<<Ping>>', when='tail')
+
+    def fire():
+        nonlocal timer
+        due.append(time.perf_counter())
+        ping()
+        timer = root.after(int(period * 1000), fire)
+
+    timer = root.after(int(period * 1000), fire)
+    ticks = await example_tasks.spin(example_tasks.NullDisplay(), ntasks, duration)
+    root.after_cancel(timer)
+    if is_headless(root):
+        root.deletefilehandler(read_fd)
+        os.close(read_fd)
+        os.close(write_fd)
+    return ticks, samples
+
+
+def run(async_fn, *args, pass_root=False, **host_kwargs):
+    root, headless = make_root()
+    host = TkHost(root, **host_kwargs)
+    if pass_root:
+        args = (root, *args)
+    result = None
+
+    def done_callback(outcome):
+        nonlocal result
+        if isinstance(outcome, Error):
+            exc = outcome.error
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+        result = outcome.unwrap()
+        if headless:
+            root.quit()
+        else:
+            root.destroy()
+
+    trio.lowlevel.start_guest_run(
+        async_fn,
+        *args,
+        run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+        run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+        done_callback=done_callback,
+    )
+    # with no windows, mainloop only keeps going if told to run until quit()
+    root.mainloop(-1 if headless else 0)
+    return result
+
+
+MODES = {
+    "single": dict(batch=False),
+    "count": dict(batch=True),
+    "fair": dict(policy="fair"),
+    "eager": dict(policy="eager"),
+    "adaptive": dict(policy="adaptive"),
+    "idle": dict(after="idle"),
+    "idle0": dict(after="idle after 0"),
+}
+
+
+def p50_p99(samples):
+    samples = sorted(samples)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+def main(duration=1.0):
+    print(
+        f"{'mode':8} {'ticks/s':>10} {'pongs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        f" {'gui t/s':>10} {'ev p50':>8} {'ev p99':>8}"
+    )
+    for mode, host_kwargs in MODES.items():
+        ticks = run(example_tasks.spin, example_tasks.NullDisplay(), 10, duration, **host_kwargs)
+        pongs = run(example_tasks.ping_pong, example_tasks.NullDisplay(), duration, **host_kwargs)
+        samples = sorted(run(lateness, 0.01, duration, **host_kwargs))
+        p50, p99 = p50_p99(samples)
+        gui_ticks, events = run(gui_load, 10, duration, pass_root=True, **host_kwargs)
+        ev_p50, ev_p99 = p50_p99(events)
+        print(
+            f"{mode:8} {ticks:10.0f} {pongs:10.0f} "
+            f"{p50 * 1000:8.3f} {p99 * 1000:8.3f} {samples[-1] * 1000:8.3f}"
+            f" {gui_ticks:10.0f} {ev_p50 * 1000:8.3f} {ev_p99 * 1000:8.3f}"
+        )
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:2]))
@@ -0,0 +1,167 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Run many tasks in one guest run, each with its own row on a dashboard
+
+run_dashboard is itself a task, so it goes through any host's main(). Each
+task gets a Row as its display. Rows only store what they are told and mark
+themselves dirty, so a task can call set_value as often as it likes. Every
+1/fps seconds the dirty rows go to a board in one batch, so the widget work per
+frame depends on how many rows changed, not how many updates there were.
+
+A board is toolkit specific and needs two methods:
+
+- add_rows(rows): called once with every row before any task starts
+- update_rows(rows): called with the rows that changed since the last frame
+
+See TkBoard, QtBoard and TqdmBoard in the trio_guest_* modules, and their
+dashboard_main functions.
+
+The host's own display shows overall progress: tasks finished out of the total,
+with the aggregate rate of set_value progress across all rows in the title.
+"""
+import time
+
+import trio
+
+WAITING = "waiting"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Row:
+    """Display for one task on a dashboard"""
+
+    def __init__(self, index, dirty):
+        self.index = index
+        self.title = f"Task {index}"
+        self.maximum = 0
+        self.value = 0
+        self.state = WAITING
+        self.error = None
+        self.cancel_requested = False
+        self._cancel = None
+        self._dirty = dirty
+        self._dirty.add(self)
+
+    def set_title(self, title):
+        self.title = title
+        self._dirty.add(self)
+
+    def set_max(self, maximum):
+        self.maximum = maximum
+        self._dirty.add(self)
+
+    def set_value(self, downloaded):
+        self.value = downloaded
+        self._dirty.add(self)
+
+    def set_cancel(self, fn):
+        self._cancel = fn
+
+    def cancel(self):
+        """Cancel the task through whatever set_cancel was last given"""
+        self.cancel_requested = True
+        if self._cancel is not None:
+            self._cancel()
+
+    def set_state(self, state, error=None):
+        self.state = state
+        self.error = error
+        self._dirty.add(self)
+
+    def progress_text(self):
+        if self.state == FAILED:
+            return f"{type(self.error).__name__}: {self.error}"
+        if self.maximum:
+            return f"{100 * self.value // self.maximum}%"
+        return str(self.value)
+
+
+async def _run_row(task, row, limiter, on_finish):
+    with trio.CancelScope() as cscope:
+        # a task that calls set_cancel itself will replace this
+        row.set_cancel(cscope.cancel)
+        async with limiter:
+            row.set_state(RUNNING)
+            try:
+                await task(row)
+            except Exception as exc:
+                # one bad task shouldn't take down the whole dashboard
+                row.set_state(FAILED, exc)
+            else:
+                row.set_state(DONE)
+    # If the task replaced our cancel, its own scope catches the cancellation and
+    # it returns normally, so go by what was asked for
+    if cscope.cancelled_caught or (row.cancel_requested and row.state == DONE):
+        row.set_state(CANCELLED)
+    on_finish()
+
+
+async def run_dashboard(display, tasks, make_board, limit=10, fps=10):
+    """Run tasks with at most limit at a time, showing each on a board row
+
+    make_board(display) builds the board. It gets the host display so that it can
+    find the toolkit objects it needs.
+    """
+    display.set_title(f"Running {len(tasks)} tasks...")
+    display.set_max(len(tasks))
+    board = make_board(display)
+    dirty = set()
+    rows = [Row(i, dirty) for i in range(len(tasks))]
+    board.add_rows(rows)
+    dirty.clear()
+    limiter = trio.CapacityLimiter(limit)
+    finished = 0
+
+    def on_finish():
+        nonlocal finished
+        finished += 1
+
+    async def refresh():
+        last_time = time.perf_counter()
+        last_total = 0
+        rate = 0
+        while True:
+            await trio.sleep(1 / fps)
+            now = time.perf_counter()
+            total = sum(row.value for row in rows)
+            # smooth it a little so the title is readable
+            rate = 0.8 * rate + 0.2 * (total - last_total) / (now - last_time)
+            last_time, last_total = now, total
+            display.set_title(
+                f"{finished}/{len(rows)} done, {limiter.borrowed_tokens} active, {rate:.4g}/s"
+            )
+            display.set_value(finished)
+            if dirty:
+                changed = sorted(dirty, key=lambda row: row.index)
+                dirty.clear()
+                board.update_rows(changed)
+
+    with trio.CancelScope() as cscope:
+        display.set_cancel(cscope.cancel)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(refresh)
+            async with trio.open_nursery() as task_nursery:
+                for task, row in zip(tasks, rows):
+                    task_nursery.start_soon(_run_row, task, row, limiter, on_finish)
+            nursery.cancel_scope.cancel()
+    display.set_title(f"{finished}/{len(rows)} done")
+    display.set_value(finished)
+    if dirty:
+        board.update_rows(sorted(dirty, key=lambda row: row.index))
+    return 1
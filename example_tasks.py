@@ -1,60 +1,592 @@
+import hashlib
 import math
+import os
+import random
 import sys
 import time
 import warnings
-from functools import partial
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import lru_cache, partial
 
-import httpx
 import trio
-import httpcore._async.http11
 
-# Default is 4096
-httpcore._async.http11.AsyncHTTP11Connection.READ_NUM_BYTES = 100_000
+from latency_recorder import LatencyRecorder, format_summary
+from offload import open_offload, take_batch
+from shared_executor import to_thread
+from throttle import ThrottledDisplay
 
 
-async def get(display):
+def set_read_size(nbytes):
+    """Set how many bytes httpcore asks for in each socket read
+
+    httpcore only exposes this as a class attribute (64 KiB in httpcore 1.x, 4096
+    before that), so it applies to every HTTP/1.1 connection in the process.
+    """
+    import httpcore._async.http11
+
+    httpcore._async.http11.AsyncHTTP11Connection.READ_NUM_BYTES = nbytes
+
+
+def _pwritev(fd, buffers, offset):
+    """Write all of buffers to fd starting at offset, without joining them"""
+    if hasattr(os, "pwritev"):
+        written = os.pwritev(fd, buffers, offset)
+    else:
+        # Windows: only our single writer thread touches the file position
+        os.lseek(fd, offset, os.SEEK_SET)
+        written = 0
+    # finish any short write one buffer at a time
+    for buffer in buffers:
+        if written >= len(buffer):
+            written -= len(buffer)
+            offset += len(buffer)
+            continue
+        view = memoryview(buffer)[written:]
+        written = 0
+        while view:
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(fd, view, offset)
+            else:
+                n = os.write(fd, view)
+            view = view[n:]
+            offset += n
+
+
+def _write_batch(fd, batch):
+    """Write (offset, chunk) pairs, one syscall per contiguous run"""
+    buffers = []
+    start = end = None
+    for offset, chunk in batch:
+        if buffers and offset == end:
+            buffers.append(chunk)
+        else:
+            if buffers:
+                _pwritev(fd, buffers, start)
+            start, buffers = offset, [chunk]
+        end = offset + len(chunk)
+    if buffers:
+        _pwritev(fd, buffers, start)
+
+
+def _preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not on this platform or filesystem, at least set the size
+        os.ftruncate(fd, size)
+
+
+class FileSink:
+    """Write download chunks to known offsets in a file
+
+    Chunks are queued on a bounded channel, so fast downloads wait for the disk,
+    and written through shared_executor.to_thread so the guest never blocks on
+    file I/O.
+    Use open_file_sink to make one.
+    """
+
+    def __init__(self, fd, send_channel):
+        self.fd = fd
+        self._send_channel = send_channel
+        self.final_size = None
+
+    async def preallocate(self, size):
+        """Reserve size bytes up front so positional writes don't grow the file"""
+        await to_thread(_preallocate, self.fd, size)
+
+    async def write(self, offset, chunk):
+        await self._send_channel.send((offset, chunk))
+
+    def set_final_size(self, size):
+        """Cut the file to size bytes once every queued write is done
+
+        Preallocation never shrinks a file, so this drops whatever an earlier,
+        longer body left past the end.
+        """
+        self.final_size = size
+
+
+async def _drain_to_file(fd, receive_channel, max_batch=64):
+    async with receive_channel:
+        async for item in receive_channel:
+            batch = take_batch(receive_channel, item, max_batch)
+            await to_thread(_write_batch, fd, batch)
+
+
+@asynccontextmanager
+async def open_file_sink(path, max_buffer=16):
+    """Open path for writing and yield a FileSink, waiting for all writes on exit"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = await to_thread(os.open, path, flags, 0o666)
+    try:
+        send_channel, receive_channel = trio.open_memory_channel(max_buffer)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(_drain_to_file, fd, receive_channel)
+            async with send_channel:
+                sink = FileSink(fd, send_channel)
+                yield sink
+        if sink.final_size is not None:
+            await to_thread(os.ftruncate, fd, sink.final_size)
+    finally:
+        os.close(fd)
+
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """Errors after which it's worth asking for the rest of the body again
+
+    A function so that importing this module doesn't import httpx.
+    """
+    import httpcore
+    import httpx
+
+    return (
+        httpx.ReadTimeout,
+        httpx.ReadError,
+        httpx.RemoteProtocolError,
+        httpcore.ReadTimeout,
+    )
+
+
+def _backoff(attempt, base=0.1, cap=10.0):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _validator(headers):
+    """A validator for If-Range: a strong ETag, or else Last-Modified, or None"""
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+
+def _check_content_range(response, start):
+    content_range = response.headers.get("content-range", "")
+    if not content_range.startswith(f"bytes {start}-"):
+        raise RuntimeError(f"Asked for bytes from {start} but got {content_range!r}")
+
+
+async def _probe_ranges(client, url):
+    """If the server will serve byte ranges of url, return (size, validator), else None"""
+    response = await client.head(url)
+    if (
+        response.status_code != 200
+        or response.headers.get("accept-ranges", "").lower() != "bytes"
+        or "content-length" not in response.headers
+    ):
+        return None
+    return int(response.headers["content-length"]), _validator(response.headers)
+
+
+def _split_ranges(total, parts):
+    """Split [0, total) into at most parts contiguous non-empty [start, stop) ranges"""
+    bounds = [total * i // parts for i in range(parts + 1)]
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+
+
+async def _fetch_range(client, url, start, stop, validator, on_chunk, attempts=10):
+    """Stream bytes [start, stop) of url, awaiting on_chunk(offset, chunk) as they arrive
+
+    After a retryable error the next attempt picks up where the last one left off.
+    """
+    for i in range(attempts):
+        headers = {"range": f"bytes={start}-{stop - 1}"}
+        if validator is not None:
+            headers["if-range"] = validator
+        try:
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code != 206:
+                    raise RuntimeError(f"Expected 206 Partial Content, got {response.status_code}")
+                _check_content_range(response, start)
+                async for chunk in response.aiter_raw():
+                    await on_chunk(start, chunk)
+                    start += len(chunk)
+            return
+        except retryable_errors() as exc:
+            print(f"Range {start}-{stop - 1} failed on attempt {i}: {exc!r}")
+            await trio.sleep(_backoff(i))
+    raise RuntimeError(f"Range {start}-{stop - 1} failed {attempts} times")
+
+
+async def _serve_cached(cache, url, entry, display, sink, on_chunk, read_size):
+    """Replay a cached body through on_chunk(offset, chunk), as if downloading it
+
+    If the body was evicted since it was looked up, forget the entry and return
+    False. Once the file is open, eviction can't take it away from us.
+    """
     try:
-        url = sys.argv[1]
-    except IndexError:
-        url = "http://google.com/"
+        f = await trio.open_file(cache.path(entry), "rb")
+    except FileNotFoundError:
+        await to_thread(cache.forget, url)
+        return False
+    display.set_max(entry["size"])
+    if sink is not None:
+        await sink.preallocate(entry["size"])
+    offset = 0
+    async with f:
+        while True:
+            chunk = await f.read(read_size)
+            if not chunk:
+                break
+            await on_chunk(offset, chunk)
+            offset += len(chunk)
+    await to_thread(cache.touch, entry)
+    return True
+
+
+class _CacheWriter:
+    """Write a cacheable 200 response into an HTTPCache as it arrives
+
+    Use _open_cache_writer to make one.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.path = None
+        self.headers = None
+        self.size = None
+        self._sink = None
+        self._stack = AsyncExitStack()
+
+    async def begin(self, response):
+        """Start writing, if response is a cacheable 200 and we haven't already
+
+        A later 200 for the same request starts over from offset 0 in the same file.
+        """
+        if (
+            self._sink is None
+            and response.status_code == 200
+            and self.cache.cacheable(response.headers)
+        ):
+            self.path = await to_thread(self.cache.temp_path)
+            self._sink = await self._stack.enter_async_context(open_file_sink(self.path))
+
+    async def write(self, offset, chunk):
+        if self._sink is not None:
+            await self._sink.write(offset, chunk)
+
+    def complete(self, response, size):
+        """All size bytes of the body have arrived, the last of them in response"""
+        if self._sink is not None and response.status_code in (200, 206):
+            self.headers = response.headers
+            self.size = size
+
+
+@asynccontextmanager
+async def _open_cache_writer(cache, url):
+    """Yield a _CacheWriter, then store what it wrote under url if it completed"""
+    writer = _CacheWriter(cache)
     try:
-        size_guess = int(sys.argv[2])
-    except IndexError:
-        size_guess = 5269
-    fps = 60
-    display.set_title(f"Fetching {url}...")
+        async with writer._stack:
+            yield writer
+    finally:
+        if writer.path is not None:
+            with trio.CancelScope(shield=True):
+                if writer.headers is not None:
+                    await to_thread(cache.store, url, writer.path, writer.headers, writer.size)
+                else:
+                    await to_thread(cache.discard, writer.path)
+
+
+def _prepare(display, url, size_guess, read_size, verb):
+    """Common setup for get and sha256
+
+    url and size_guess default to the first two command line arguments, and
+    read_size, unless None, is passed to set_read_size. Returns
+    (display, url, size_guess), with display wrapped in a ThrottledDisplay and
+    titled "<verb> <url>...".
+    """
+    if url is None:
+        try:
+            url = sys.argv[1]
+        except IndexError:
+            url = "http://google.com/"
+    if size_guess is None:
+        try:
+            size_guess = int(sys.argv[2])
+        except IndexError:
+            size_guess = 5269
+    if read_size is not None:
+        set_read_size(read_size)
+    display = ThrottledDisplay(display)
+    display.set_title(f"{verb} {url}...")
+    return display, url, size_guess
+
+
+async def get(
+    display, url=None, size_guess=None, read_size=None, connections=1, dest=None, cache=None
+):
+    """Download url, showing progress on display
+
+    url and size_guess (used when there is no content-length) default to the
+    first two command line arguments. If read_size is given, it is passed to
+    set_read_size before connecting. That changes it for the whole process, so
+    by default httpcore's read size is left alone.
+
+    With connections > 1, if a HEAD request shows the server accepts byte ranges,
+    the body is split into that many ranges which are fetched at the same time.
+    Otherwise we fall back to a single stream.
+
+    If a transfer breaks, we wait with jittered exponential backoff and then ask
+    for the rest with a Range header, validated with If-Range against the ETag or
+    Last-Modified of the first response. If the server sends the whole body
+    (200) instead, we start over from byte zero, and dest is cut to the new
+    length at the end. A 5xx answer is retried after the same backoff, and any
+    other status raises RuntimeError.
+
+    If dest is a path, the body is written there through a FileSink, preallocated
+    from the content-length. Otherwise the bytes are only counted.
+
+    cache is an http_cache.HTTPCache. If it holds url, the first request carries
+    If-None-Match / If-Modified-Since, and on 304 Not Modified the body is read
+    back from disk and goes to display and dest just as a download would. A 200
+    with an ETag or Last-Modified is written to the cache as it arrives, and
+    stored once complete. With a cache we always use a single stream.
+    """
+    import httpx
+
+    display, url, size_guess = _prepare(display, url, size_guess, read_size, "Fetching")
     with trio.CancelScope() as cscope:
         display.set_cancel(cscope.cancel)
         start = time.monotonic()
         downloaded = 0
-        last_screen_update = time.monotonic()
-        async with httpx.AsyncClient() as client:
-            for i in range(10):
-                print("Connection attempt", i)
-                try:
-                    async with client.stream("GET", url) as response:
-                        total = int(response.headers.get("content-length", size_guess))
-                        display.set_max(total)
-                        async for chunk in response.aiter_raw():
-                            downloaded += len(chunk)
-                            if time.monotonic() - last_screen_update > 1 / fps:
-                                display.set_value(downloaded)
-                                last_screen_update = time.monotonic()
-                    break
-                except httpcore._exceptions.ReadTimeout:
-                    pass
+        sink = None
+        writer = None
+
+        async def on_chunk(offset, chunk):
+            nonlocal downloaded
+            downloaded += len(chunk)
+            display.set_value(downloaded)
+            if sink is not None:
+                await sink.write(offset, chunk)
+            if writer is not None:
+                await writer.write(offset, chunk)
+
+        # httpx defaults, but with room for every range
+        limits = httpx.Limits(max_connections=max(connections, 100), max_keepalive_connections=20)
+        async with httpx.AsyncClient(limits=limits) as client, AsyncExitStack() as stack:
+            if dest is not None:
+                sink = await stack.enter_async_context(open_file_sink(dest))
+            probe = await _probe_ranges(client, url) if connections > 1 and cache is None else None
+            if probe is not None:
+                total, validator = probe
+                display.set_max(total)
+                if sink is not None:
+                    await sink.preallocate(total)
+                async with trio.open_nursery() as nursery:
+                    for range_start, range_stop in _split_ranges(total, connections):
+                        nursery.start_soon(
+                            _fetch_range,
+                            client,
+                            url,
+                            range_start,
+                            range_stop,
+                            validator,
+                            on_chunk,
+                        )
             else:
-                print("response timed out 10 times")
-                return
+                validator = None
+                cached = None
+                if cache is not None:
+                    cached = await to_thread(cache.lookup, url)
+                    writer = await stack.enter_async_context(_open_cache_writer(cache, url))
+                for i in range(10):
+                    print("Connection attempt", i)
+                    headers = {}
+                    if downloaded:
+                        headers["range"] = f"bytes={downloaded}-"
+                        if validator is not None:
+                            headers["if-range"] = validator
+                    elif cached is not None:
+                        headers.update(cache.conditional_headers(cached))
+                    try:
+                        async with client.stream("GET", url, headers=headers) as response:
+                            if cached is not None and response.status_code == 304:
+                                print("Not modified, reading from cache")
+                                if await _serve_cached(
+                                    cache, url, cached, display, sink, on_chunk, read_size or 65536
+                                ):
+                                    break
+                                print("Cached body was evicted, asking again without validators")
+                                cached = None
+                                continue
+                            if downloaded and response.status_code == 206:
+                                _check_content_range(response, downloaded)
+                            elif downloaded and response.status_code != 200:
+                                if response.status_code < 500:
+                                    raise RuntimeError(
+                                        "Expected 206 Partial Content or 200 OK, "
+                                        f"got {response.status_code}"
+                                    )
+                                print(
+                                    f"Attempt {i} got {response.status_code} "
+                                    f"after {downloaded} bytes"
+                                )
+                                await response.aclose()
+                                await trio.sleep(_backoff(i))
+                                continue
+                            else:
+                                if downloaded:
+                                    print("Server sent the whole body, starting over")
+                                    downloaded = 0
+                                validator = _validator(response.headers)
+                                if sink is not None and "content-length" in response.headers:
+                                    await sink.preallocate(int(response.headers["content-length"]))
+                                total = int(response.headers.get("content-length", size_guess))
+                                display.set_max(total)
+                                if writer is not None:
+                                    await writer.begin(response)
+                            async for chunk in response.aiter_raw():
+                                await on_chunk(downloaded, chunk)
+                            if writer is not None:
+                                writer.complete(response, downloaded)
+                        break
+                    except retryable_errors() as exc:
+                        print(f"Attempt {i} failed after {downloaded} bytes: {exc!r}")
+                        await trio.sleep(_backoff(i))
+                else:
+                    print("response failed 10 times")
+                    display.flush()
+                    return
+                if sink is not None:
+                    # a restarted body may be shorter than what was written before
+                    sink.set_final_size(downloaded)
         end = time.monotonic()
         dur = end - start
         bytes_per_sec = downloaded / dur
         print(f"Downloaded {downloaded} bytes in {dur:.2f} seconds")
         print(f"{bytes_per_sec:.2f} bytes/sec")
+    display.flush()
     return 1
 
 
+async def sha256(
+    display, url=None, expected=None, offload=True, read_size=None, size_guess=None
+):
+    """Download url and return its SHA-256 hex digest, showing progress on display
+
+    Hashing happens in a worker thread through an offload stage, so the host
+    keeps pumping events, and a slow hash holds back the download. With
+    offload=False the hashing runs in the task itself, for comparison.
+
+    The display counts bytes as they came over the wire, against the
+    content-length, or against size_guess (defaulting as in get) if there is
+    none. The digest is of the decoded body. read_size is as in get.
+
+    If expected is given, raise ValueError if the digest doesn't match.
+    """
+    import httpx
+
+    display, url, size_guess = _prepare(display, url, size_guess, read_size, "Hashing")
+    hasher = hashlib.sha256()
+    with trio.CancelScope() as cscope:
+        display.set_cancel(cscope.cancel)
+        async with httpx.AsyncClient() as client, client.stream("GET", url) as response:
+            response.raise_for_status()
+            display.set_max(int(response.headers.get("content-length", size_guess)))
+            if offload:
+                async with open_offload(hasher.update) as stage:
+                    async for chunk in response.aiter_bytes():
+                        await stage.send(chunk)
+                        display.set_value(response.num_bytes_downloaded)
+            else:
+                async for chunk in response.aiter_bytes():
+                    hasher.update(chunk)
+                    display.set_value(response.num_bytes_downloaded)
+            display.set_value(response.num_bytes_downloaded)
+    display.flush()
+    if cscope.cancelled_caught:
+        return None
+    digest = hasher.hexdigest()
+    print(f"sha256 {digest}")
+    if expected is not None and digest != expected.lower():
+        raise ValueError(f"SHA-256 mismatch for {url}: got {digest}, expected {expected}")
+    return digest
+
+
+async def fetch_many(
+    display,
+    urls,
+    pooled=True,
+    max_connections=10,
+    max_keepalive_connections=10,
+    keepalive_expiry=5.0,
+    http2=False,
+    http1=True,
+    concurrency=None,
+):
+    """GET every url in urls, showing requests done and requests/sec on display
+
+    With pooled=True all requests share one httpx.AsyncClient, so connections
+    to the same host are kept alive and reused, up to max_connections at a time
+    (httpx.Limits applies this per client, which for a batch against one origin
+    is per host). With http2=True (needs the h2 package) requests to a server
+    that negotiates HTTP/2 are multiplexed over one connection. Add http1=False
+    to use HTTP/2 with prior knowledge on plain http:// URLs. With pooled=False
+    each request gets a fresh client, for comparison.
+
+    At most concurrency requests (default max_connections) are in flight at once.
+    A failed request is counted and the batch goes on. Returns the number of
+    requests that got a 2xx response.
+    """
+    import httpx
+
+    urls = list(urls)
+    display = ThrottledDisplay(display)
+    display.set_title(f"Fetching {len(urls)} URLs...")
+    display.set_max(len(urls))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    client_args = dict(limits=limits, http1=http1, http2=http2)
+    pending = iter(urls)
+    done = ok = failed = 0
+    start = time.monotonic()
+
+    async def fetch(client, url):
+        nonlocal done, ok, failed
+        try:
+            response = await client.get(url)
+        except httpx.HTTPError as exc:
+            print(f"{url}: {exc!r}")
+            failed += 1
+        else:
+            if response.is_success:
+                ok += 1
+            else:
+                failed += 1
+        done += 1
+        display.set_title(f"{done / (time.monotonic() - start):.0f} requests/sec, {failed} failed")
+        display.set_value(done)
+
+    async def worker(client):
+        for url in pending:
+            if client is None:
+                async with httpx.AsyncClient(**client_args) as own_client:
+                    await fetch(own_client, url)
+            else:
+                await fetch(client, url)
+
+    with trio.CancelScope() as cscope:
+        display.set_cancel(cscope.cancel)
+        async with AsyncExitStack() as stack:
+            client = None
+            if pooled:
+                client = await stack.enter_async_context(httpx.AsyncClient(**client_args))
+            async with trio.open_nursery() as nursery:
+                for _ in range(concurrency or max_connections):
+                    nursery.start_soon(worker, client)
+    dur = time.monotonic() - start
+    print(f"{done} requests in {dur:.2f} seconds ({done / dur:.0f}/sec), {failed} failed")
+    display.flush()
+    return ok
+
+
 async def count(display, period=.1, max=60):
+    display = ThrottledDisplay(display)
     display.set_title(f"Counting every {period} seconds...")
     display.set_max(60)
     with trio.CancelScope() as cancel_scope:
@@ -62,19 +594,105 @@ async def count(display, period=.1, max=60):
         for i in range(max):
             await trio.sleep(period)
             display.set_value(i)
+    display.flush()
     return 1
 
 
-async def check_latency(display=None, period=0.1, duration=math.inf):
+class NullDisplay:
+    """A display that ignores everything, for benchmarks and headless runs"""
+
+    def set_title(self, title):
+        pass
+
+    def set_max(self, maximum):
+        pass
+
+    def set_value(self, downloaded):
+        pass
+
+    def set_cancel(self, fn):
+        pass
+
+
+async def spin(display, ntasks=10, duration=1.0):
+    """Measure scheduler throughput with ntasks tasks looping on trio.sleep(0)
+
+    Every pass through the Trio scheduler is a guest tick, which the host runs via
+    run_sync_soon_not_threadsafe. Returns sleep(0) round trips per second.
+    """
+    display.set_title(f"Spinning {ntasks} tasks for {duration} seconds...")
+    display.set_max(ntasks)
+    ticks = 0
+
+    async def spinner():
+        nonlocal ticks
+        while True:
+            await trio.sleep(0)
+            ticks += 1
+
+    start = trio.current_time()
+    async with trio.open_nursery() as nursery:
+        display.set_cancel(nursery.cancel_scope.cancel)
+        nursery.cancel_scope.deadline = start + duration
+        for _ in range(ntasks):
+            nursery.start_soon(spinner)
+    display.set_value(ntasks)
+    return ticks / (trio.current_time() - start)
+
+
+async def ping_pong(display, duration=1.0):
+    """Measure cross-thread wakeups with a trio.to_thread.run_sync ping-pong
+
+    Each round trip ends with the worker thread waking the guest via
+    run_sync_soon_threadsafe. Returns round trips per second.
+    """
+    display.set_title(f"Ping-ponging with a thread for {duration} seconds...")
+    display.set_max(1)
+    pongs = 0
+    start = trio.current_time()
+    with trio.move_on_after(duration) as cscope:
+        display.set_cancel(cscope.cancel)
+        while True:
+            await trio.to_thread.run_sync(int)
+            pongs += 1
+    display.set_value(1)
+    return pongs / (trio.current_time() - start)
+
+
+async def check_latency(display=None, period=0.1, duration=math.inf, recorder=None, report_interval=None):
+    """Measure how late trio.sleep_until wakes up, every period seconds
+
+    Samples go into recorder (a fresh LatencyRecorder if None) rather than to
+    stdout, so the loop being measured does no I/O. Every report_interval
+    seconds, if given, a summary of the samples since the last report is printed
+    and shown as the display title. A summary of the whole run is printed at the
+    end, and returned.
+    """
+    if recorder is None:
+        recorder = LatencyRecorder()
     with trio.move_on_after(duration) as cscope:
         if display is not None:
             display.set_cancel(cscope.cancel)
         elif duration == math.inf:
             warnings.warn("check_latency may not terminate until the process is killed")
+        next_report = math.inf if report_interval is None else trio.current_time() + report_interval
+        reported = 0
         while True:
             target = trio.current_time() + period
             await trio.sleep_until(target)
-            print(trio.current_time() - target, flush=True)
+            now = trio.current_time()
+            recorder.record(now - target)
+            if now >= next_report:
+                text = format_summary(recorder.summary(since=reported))
+                print(text, flush=True)
+                if display is not None:
+                    display.set_title(text)
+                reported = recorder.count
+                next_report = now + report_interval
+    recorder.close()
+    summary = recorder.summary()
+    print(format_summary(summary), flush=True)
+    return summary
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Measure how a host loop keeps up with its Trio guest
+
+HostMetrics wraps a host's run_sync_soon_threadsafe and run_sync_soon_not_threadsafe
+so that every thunk is timestamped when it is scheduled and again when the host
+runs it. That gives you:
+
+- scheduling delay: how long thunks wait in the host loop. If this is high, the
+  GUI loop is congested.
+- run time: how long each thunk (nearly always a guest tick) takes. If this is
+  high, Trio tasks are hogging the loop between checkpoints.
+- queue depth: thunks scheduled but not yet run.
+
+Call instrument(host) before passing the host's methods to start_guest_run.
+Read the numbers with snapshot() or prometheus_text(), or pass a callback to
+have snapshots pushed to you from the host thread every interval seconds.
+
+Run this module to see a dump for example_tasks.count on asyncio.
+"""
+import bisect
+import threading
+import time
+
+# Bucket upper bounds in seconds: 1 us doubling up to about 8 s
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(24))
+
+
+class Histogram:
+    """Cumulative histogram of durations in seconds with power-of-two buckets"""
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (0 <= q <= 1)"""
+        if not self.count:
+            return float("nan")
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else float("nan"),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class HostMetrics:
+    def __init__(self, callback=None, interval=1.0):
+        self.scheduling_delay = Histogram()
+        self.run_time = Histogram()
+        self.scheduled = {"threadsafe": 0, "not_threadsafe": 0}
+        # += isn't atomic, and threadsafe calls come from several threads
+        self._lock = threading.Lock()
+        self.ran = 0
+        self.max_queue_depth = 0
+        self.callback = callback
+        self.interval = interval
+        self._next_report = time.perf_counter() + interval
+
+    def instrument(self, host):
+        """Wrap host's run_sync_soon_* methods in place and return host"""
+        for path in self.scheduled:
+            name = "run_sync_soon_" + path
+            schedule = getattr(host, name, None)
+            if schedule is not None:
+                setattr(host, name, self.wrap(path, schedule))
+        return host
+
+    def wrap(self, path, schedule):
+        """Return an instrumented version of a run_sync_soon_* function"""
+        perf_counter = time.perf_counter
+        counts = self.scheduled
+        lock = self._lock
+
+        def run_sync_soon(func):
+            scheduled = perf_counter()
+
+            def timed():
+                start = perf_counter()
+                self.scheduling_delay.observe(start - scheduled)
+                try:
+                    func()
+                finally:
+                    end = perf_counter()
+                    self.run_time.observe(end - start)
+                    self.ran += 1
+                    if self.callback is not None and end >= self._next_report:
+                        self._next_report = end + self.interval
+                        self.callback(self.snapshot())
+
+            with lock:
+                counts[path] += 1
+                depth = sum(counts.values()) - self.ran
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+            schedule(timed)
+
+        return run_sync_soon
+
+    @property
+    def queue_depth(self):
+        return sum(self.scheduled.values()) - self.ran
+
+    def snapshot(self):
+        return {
+            "scheduled": dict(self.scheduled),
+            "ran": self.ran,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "scheduling_delay": self.scheduling_delay.summary(),
+            "run_time": self.run_time.summary(),
+        }
+
+    def prometheus_text(self, prefix="trio_guest"):
+        """Dump everything in the Prometheus text exposition format"""
+        lines = []
+        for name, help_text, histogram in (
+            ("scheduling_delay_seconds", "Wait from run_sync_soon_* to run", self.scheduling_delay),
+            ("run_time_seconds", "Time spent running each thunk", self.run_time),
+        ):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            labels = [repr(bound) for bound in histogram.bounds] + ["+Inf"]
+            for bound, count in zip(labels, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        metric = f"{prefix}_scheduled_total"
+        lines.append(f"# HELP {metric} Thunks scheduled by the guest")
+        lines.append(f"# TYPE {metric} counter")
+        for path, count in self.scheduled.items():
+            lines.append(f'{metric}{{path="{path}"}} {count}')
+        for name, kind, help_text, value in (
+            ("ticks_total", "counter", "Thunks run by the host", self.ran),
+            ("queue_depth", "gauge", "Thunks waiting to run", self.queue_depth),
+            ("queue_depth_max", "gauge", "Most thunks ever waiting", self.max_queue_depth),
+        ):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    import asyncio
+    from functools import partial
+
+    import trio
+
+    import example_tasks
+    from trio_guest_asyncio import AioHost, TqdmDisplay
+
+    async def amain():
+        metrics = HostMetrics(callback=print)
+        host = metrics.instrument(AioHost(asyncio.get_running_loop()))
+        display = TqdmDisplay()
+        trio.lowlevel.start_guest_run(
+            partial(example_tasks.count, period=0.01, max=200),
+            display,
+            run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+            run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+            done_callback=host.done_callback,
+            host_uses_signal_set_wakeup_fd=True,
+        )
+        await host.done_fut
+        display.pbar.close()
+        print(metrics.prometheus_text())
+
+    asyncio.run(amain())
@@ -0,0 +1,173 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" An on-disk cache of response bodies for conditional requests
+
+Each URL's body is kept in a file named after the SHA-256 of the URL, next to
+an index.json holding its ETag, Last-Modified, size and last use. The headers
+from conditional_headers(entry) turn a repeat fetch into a 304 if nothing has
+changed, and the body can then be read back from path(entry).
+
+When the total size goes over max_bytes, the least recently used entries are
+evicted. This is meant for one process at a time, but any number of threads:
+get() calls these methods from worker threads, so a lock guards the index.
+The index is rewritten to a fresh temporary file and moved into place with
+os.replace after each change, so a crash can't leave it half written.
+
+See example_tasks.get(cache=...) for the whole round trip.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class HTTPCache:
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(directory, "index.json")
+        try:
+            with open(self._index_path) as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+        # bodies served from disk, and bodies downloaded and stored
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry["key"] + ".body")
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def lookup(self, url):
+        """The entry for url, or None if there is none or its body has gone"""
+        with self._lock:
+            entry = self.index.get(self.key(url))
+            if entry is not None and not os.path.exists(self.path(entry)):
+                self._remove(entry)
+                self._save()
+                return None
+            return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["if-none-match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["if-modified-since"] = entry["last_modified"]
+        return headers
+
+    @staticmethod
+    def cacheable(headers):
+        """Whether a 200 response with these headers is worth storing"""
+        if "no-store" in headers.get("cache-control", "").lower():
+            return False
+        return "etag" in headers or "last-modified" in headers
+
+    def temp_path(self):
+        """A fresh file in the cache directory to write a body to before store()"""
+        fd, path = tempfile.mkstemp(suffix=".part", dir=self.directory)
+        os.close(fd)
+        return path
+
+    def store(self, url, temp_path, headers, size=None):
+        """Move a complete body from temp_path into the cache, then evict to fit
+
+        If size is given, temp_path is first cut down to that many bytes.
+        """
+        if size is None:
+            size = os.path.getsize(temp_path)
+        else:
+            os.truncate(temp_path, size)
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return None
+        key = self.key(url)
+        entry = {
+            "key": key,
+            "url": url,
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "size": size,
+            "last_used": time.time(),
+        }
+        with self._lock:
+            os.replace(temp_path, self.path(entry))
+            self.misses += 1
+            self.index[key] = entry
+            self._evict()
+            self._save()
+        return entry
+
+    def touch(self, entry):
+        """Mark entry as just used, after serving it"""
+        with self._lock:
+            self.hits += 1
+            entry["last_used"] = time.time()
+            self._save()
+
+    def discard(self, temp_path):
+        """Throw away a body that was never stored"""
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def forget(self, url):
+        with self._lock:
+            entry = self.index.get(self.key(url))
+            if entry is not None:
+                self._remove(entry)
+                self._save()
+
+    # The rest expect the caller to hold self._lock
+
+    def _remove(self, entry):
+        del self.index[entry["key"]]
+        try:
+            os.remove(self.path(entry))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        for entry in sorted(self.index.values(), key=lambda entry: entry["last_used"]):
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            total -= entry["size"]
+
+    def _save(self):
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.index, f)
+            os.replace(temp, self._index_path)
+        except BaseException:
+            os.remove(temp)
+            raise
@@ -0,0 +1,340 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" A tiny local HTTP/1.1 server to stand in for the internet in benchmarks
+
+GET /bytes/<n> returns n bytes of deterministic pseudo-random data. Query
+parameters pace the response:
+
+- chunk: bytes per write (default 65536)
+- delay: seconds to sleep between writes (default 0)
+- ranges: set to 0 to ignore Range headers and not advertise Accept-Ranges
+- fail_after: drop the connection after sending this many body bytes, to
+  simulate a flaky link
+- version: changes the ETag, to simulate the resource changing
+
+Single byte ranges ("Range: bytes=a-b", "bytes=a-" or "bytes=-n") get a 206
+response, unless an If-Range header doesn't match the ETag or Last-Modified.
+A matching If-None-Match, or failing that an If-Modified-Since no earlier than
+Last-Modified, gets a 304 Not Modified with no body.
+Connections are kept alive unless the client asks otherwise.
+
+If the h2 package is installed, a client that opens with the HTTP/2 connection
+preface (prior knowledge, as httpx does with http1=False) is served over
+HTTP/2. Only plain GET and HEAD of /bytes/<n> are supported there.
+
+Run it in the foreground with "python http_standin.py [port]", or in a
+background thread with "with standin_server() as base_url: ...".
+"""
+import contextlib
+import email.utils
+import random
+import sys
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import trio
+
+BLOCK_SIZE = 1 << 20
+# Random so nothing along the way can compress it
+BLOCK = random.Random(0).randbytes(BLOCK_SIZE)
+MAX_HEADER_BYTES = 65536
+LAST_MODIFIED = "Wed, 01 Jan 2020 00:00:00 GMT"
+
+
+def payload(start, stop):
+    """Yield memoryviews covering bytes [start, stop) of the endless payload"""
+    view = memoryview(BLOCK)
+    while start < stop:
+        offset = start % BLOCK_SIZE
+        piece = view[offset : offset + stop - start]
+        yield piece
+        start += len(piece)
+
+
+def payload_bytes(size):
+    """The bytes a client should receive from /bytes/<size>"""
+    return b"".join(payload(0, size))
+
+
+class BadRequest(Exception):
+    pass
+
+
+def not_modified(headers, etag):
+    """Whether a request's conditional headers say the client's copy is current"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since >= email.utils.parsedate_to_datetime(LAST_MODIFIED)
+
+
+def parse_range(header, size):
+    """Parse a single "bytes=" range into [start, stop), or None to send everything
+
+    Raises ValueError if the range can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        start, stop = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        stop = min(size, int(last) + 1) if last else size
+    if start >= stop:
+        raise ValueError(header)
+    return start, stop
+
+
+async def receive_request(stream, buffer):
+    """Read one request head from stream, buffer holds any leftover bytes
+
+    Returns (method, target, headers) or None if the client closed the connection.
+    """
+    while b"\r\n\r\n" not in buffer:
+        if len(buffer) > MAX_HEADER_BYTES:
+            raise BadRequest("request head too large")
+        data = await stream.receive_some()
+        if not data:
+            return None
+        buffer += data
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    buffer[:] = rest
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = request_line.split(" ")
+    except ValueError:
+        raise BadRequest(request_line)
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+async def send_response(stream, status, headers, body=(), delay=0):
+    head = [f"HTTP/1.1 {status}"]
+    head.extend(f"{name}: {value}" for name, value in headers.items())
+    await stream.send_all(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    for piece in body:
+        await stream.send_all(piece)
+        if delay:
+            await trio.sleep(delay)
+
+
+def chunked(pieces, chunk):
+    """Re-split an iterable of memoryviews into writes of at most chunk bytes"""
+    for piece in pieces:
+        for offset in range(0, len(piece), chunk):
+            yield piece[offset : offset + chunk]
+
+
+def truncated(pieces, limit):
+    """Stop an iterable of memoryviews after limit bytes"""
+    for piece in pieces:
+        if limit <= 0:
+            return
+        yield piece[:limit]
+        limit -= len(piece)
+
+
+async def handle(stream):
+    buffer = bytearray()
+    try:
+        while True:
+            try:
+                request = await receive_request(stream, buffer)
+            except BadRequest:
+                await send_response(stream, "400 Bad Request", {"content-length": 0})
+                return
+            if request is None:
+                return
+            method, target, headers = request
+            if method == "PRI" and target == "*":
+                # receive_request stopped partway into the preface; put it back
+                await serve_h2(stream, b"PRI * HTTP/2.0\r\n\r\n" + bytes(buffer))
+                return
+            keep_alive = headers.get("connection", "").lower() != "close"
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            chunk = int(query.get("chunk", ["65536"])[0])
+            delay = float(query.get("delay", ["0"])[0])
+            ranges = query.get("ranges", ["1"])[0] != "0"
+            fail_after = int(query.get("fail_after", ["-1"])[0])
+            version = query.get("version", ["0"])[0]
+            parts = url.path.strip("/").split("/")
+            response_headers = {"connection": "keep-alive" if keep_alive else "close"}
+            if method not in ("GET", "HEAD") or len(parts) != 2 or parts[0] != "bytes":
+                response_headers["content-length"] = 0
+                await send_response(stream, "404 Not Found", response_headers)
+            else:
+                size = int(parts[1])
+                status = "200 OK"
+                start, stop = 0, size
+                etag = f'"{size}-{version}"'
+                response_headers["content-type"] = "application/octet-stream"
+                response_headers["etag"] = etag
+                response_headers["last-modified"] = LAST_MODIFIED
+                if not_modified(headers, etag):
+                    await send_response(stream, "304 Not Modified", response_headers)
+                    continue
+                if_range = headers.get("if-range")
+                if ranges and if_range in (None, etag, LAST_MODIFIED):
+                    response_headers["accept-ranges"] = "bytes"
+                    try:
+                        requested = parse_range(headers.get("range", ""), size)
+                    except ValueError:
+                        response_headers["content-range"] = f"bytes */{size}"
+                        response_headers["content-length"] = 0
+                        await send_response(stream, "416 Range Not Satisfiable", response_headers)
+                        continue
+                    if requested is not None:
+                        status = "206 Partial Content"
+                        start, stop = requested
+                        response_headers["content-range"] = f"bytes {start}-{stop - 1}/{size}"
+                elif ranges:
+                    response_headers["accept-ranges"] = "bytes"
+                response_headers["content-length"] = stop - start
+                body = () if method == "HEAD" else chunked(payload(start, stop), chunk)
+                if fail_after >= 0 and method != "HEAD" and fail_after < stop - start:
+                    await send_response(
+                        stream, status, response_headers, truncated(body, fail_after), delay
+                    )
+                    return
+                await send_response(stream, status, response_headers, body, delay)
+            if not keep_alive:
+                return
+    except trio.BrokenResourceError:
+        pass
+    finally:
+        await stream.aclose()
+
+
+async def serve_h2(stream, data):
+    """Serve /bytes/<n> over HTTP/2, given the bytes received so far"""
+    try:
+        import h2.config
+        import h2.connection
+        import h2.events
+    except ImportError:
+        return  # just hang up
+
+    conn = h2.connection.H2Connection(
+        h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+    )
+    conn.initiate_connection()
+    bodies = {}  # stream id -> bytes still to send
+
+    def respond(stream_id, headers):
+        method, path = headers.get(":method"), urlsplit(headers.get(":path", "")).path
+        parts = path.strip("/").split("/")
+        if method not in ("GET", "HEAD") or len(parts) != 2 or parts[0] != "bytes":
+            conn.send_headers(stream_id, [(":status", "404"), ("content-length", "0")], end_stream=True)
+            return
+        size = int(parts[1])
+        response_headers = [
+            (":status", "200"),
+            ("content-type", "application/octet-stream"),
+            ("content-length", str(size)),
+            ("etag", f'"{size}-0"'),
+            ("last-modified", LAST_MODIFIED),
+        ]
+        if method == "HEAD" or not size:
+            conn.send_headers(stream_id, response_headers, end_stream=True)
+            return
+        conn.send_headers(stream_id, response_headers)
+        bodies[stream_id] = memoryview(payload_bytes(size))
+
+    def pump():
+        """Send as much of each body as flow control allows"""
+        for stream_id, body in list(bodies.items()):
+            window = conn.local_flow_control_window(stream_id)
+            while body and window > 0:
+                piece = body[: min(window, conn.max_outbound_frame_size)]
+                conn.send_data(stream_id, piece)
+                body = body[len(piece) :]
+                window -= len(piece)
+            if body:
+                bodies[stream_id] = body
+            else:
+                del bodies[stream_id]
+                conn.end_stream(stream_id)
+
+    while data:
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                respond(event.stream_id, dict(event.headers))
+            elif isinstance(event, h2.events.StreamReset):
+                bodies.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                await stream.send_all(conn.data_to_send())
+                return
+        pump()
+        await stream.send_all(conn.data_to_send())
+        data = await stream.receive_some()
+
+
+async def serve(port=0, host="127.0.0.1", *, task_status=trio.TASK_STATUS_IGNORED):
+    """Serve forever, reporting the bound port through task_status"""
+    listeners = await trio.open_tcp_listeners(port, host=host)
+    task_status.started(listeners[0].socket.getsockname()[1])
+    await trio.serve_listeners(handle, listeners)
+
+
+@contextlib.contextmanager
+def standin_server(host="127.0.0.1"):
+    """Run the server in a background thread, yielding its base URL"""
+    ready = threading.Event()
+    state = {}
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            state["port"] = await nursery.start(serve, 0, host)
+            state["token"] = trio.lowlevel.current_trio_token()
+            state["cancel"] = nursery.cancel_scope.cancel
+            ready.set()
+
+    def thread_main():
+        try:
+            trio.run(run)
+        finally:
+            ready.set()
+
+    thread = threading.Thread(target=thread_main, name="http_standin", daemon=True)
+    thread.start()
+    ready.wait()
+    if "port" not in state:
+        raise RuntimeError("stand-in server failed to start")
+    try:
+        yield f"http://{host}:{state['port']}"
+    finally:
+        trio.from_thread.run_sync(state["cancel"], trio_token=state["token"])
+        thread.join()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if sys.argv[1:] else 8000
+    print(f"Serving on http://127.0.0.1:{port}/bytes/<n>")
+    trio.run(serve, port)
@@ -0,0 +1,123 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Record latency samples without disturbing the loop being measured
+
+LatencyRecorder.record stores a float into a preallocated ring buffer and
+updates running totals: no allocation, no I/O. Percentiles are computed on
+demand over the samples still in the buffer, which is the whole run unless it
+has wrapped. min, max, mean and the count always cover the whole run.
+
+For soak runs, pass dump (a file opened in binary mode for "bin", text mode for
+"csv"). Each time the buffer fills, it is written out in one go, so every raw
+sample ends up in the file; call close() to write out the rest. Binary dumps
+are native-endian doubles, readable with array.array("d").fromfile or
+numpy.fromfile.
+"""
+import array
+import math
+
+SUMMARY_QUANTILES = (50, 90, 99)
+
+
+def percentile(sorted_samples, q):
+    """Nearest-rank percentile of an already sorted sequence"""
+    if not sorted_samples:
+        return float("nan")
+    index = min(len(sorted_samples) - 1, max(0, math.ceil(q * len(sorted_samples) / 100) - 1))
+    return sorted_samples[index]
+
+
+class LatencyRecorder:
+    def __init__(self, capacity=1 << 20, dump=None, dump_format="bin"):
+        if dump_format not in ("bin", "csv"):
+            raise ValueError(f"dump_format must be 'bin' or 'csv', not {dump_format!r}")
+        self.capacity = capacity
+        self._buffer = array.array("d", bytes(8 * capacity))
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+        self.dump = dump
+        self.dump_format = dump_format
+        self._dumped = 0  # count at the last dump
+
+    def record(self, sample):
+        index = self.count % self.capacity
+        self._buffer[index] = sample
+        self.count += 1
+        self.sum += sample
+        if sample < self.min:
+            self.min = sample
+        if sample > self.max:
+            self.max = sample
+        if self.dump is not None and index == self.capacity - 1:
+            self._write_dump()
+
+    def samples(self, since=0):
+        """Samples recorded from count == since onward that are still buffered, oldest first"""
+        start = max(since, self.count - self.capacity)
+        if start >= self.count:
+            return array.array("d")
+        first, last = start % self.capacity, self.count % self.capacity
+        if first < last:
+            return self._buffer[first:last]
+        return self._buffer[first:] + self._buffer[:last]
+
+    def summary(self, since=0):
+        """min/p50/p90/p99/max of buffered samples since a count, and how many went in
+
+        With since=0, min, max, mean and n cover every sample ever recorded, even
+        those that have been overwritten.
+        """
+        window = sorted(self.samples(since))
+        if since:
+            n = self.count - since
+            low = window[0] if window else float("nan")
+            high = window[-1] if window else float("nan")
+            mean = sum(window) / len(window) if window else float("nan")
+        else:
+            n = self.count
+            low = self.min if n else float("nan")
+            high = self.max if n else float("nan")
+            mean = self.sum / n if n else float("nan")
+        summary = {"n": n, "min": low}
+        for q in SUMMARY_QUANTILES:
+            summary[f"p{q}"] = percentile(window, q)
+        summary["max"] = high
+        summary["mean"] = mean
+        return summary
+
+    def _write_dump(self):
+        pending = self.samples(self._dumped)
+        if self.count - self._dumped > len(pending):
+            raise RuntimeError("latency samples were overwritten before being dumped")
+        if self.dump_format == "bin":
+            pending.tofile(self.dump)
+        else:
+            self.dump.writelines(f"{sample!r}\n" for sample in pending)
+        self._dumped = self.count
+
+    def close(self):
+        """Write out any samples not yet dumped"""
+        if self.dump is not None and self._dumped < self.count:
+            self._write_dump()
+            self.dump.flush()
+
+
+def format_summary(summary, scale=1000, unit="ms"):
+    keys = ["min"] + [f"p{q}" for q in SUMMARY_QUANTILES] + ["max"]
+    values = " ".join(f"{key}={summary[key] * scale:.3f}" for key in keys)
+    return f"n={summary['n']} {values} {unit}"
@@ -0,0 +1,122 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Move CPU-heavy work on streamed chunks off the host thread
+
+Guest ticks run on the host's GUI thread, so hashing or decompressing chunks
+inside a task freezes the GUI. open_offload gives you a stage that sends each
+chunk through a bounded memory channel to fn in a worker:
+
+- with executor=None, queued chunks are passed to fn in batches, one batch at a
+  time, through shared_executor.to_thread: in the shared pool if one is
+  installed, or else in a Trio worker thread. This suits stateful fns like
+  hasher.update, as long as they release the GIL (hashlib and zlib do for
+  large buffers).
+- with a concurrent.futures executor (such as a ProcessPoolExecutor), up to
+  max_pending calls run at once, so fn should not depend on earlier calls.
+
+Either way, fn sees chunks in order, on_result gets results in order on the
+Trio side, and send() blocks once max_buffer chunks are waiting, which slows the
+producer down to the worker's pace.
+"""
+import collections
+from contextlib import asynccontextmanager
+
+import trio
+
+from shared_executor import to_thread, wait_future
+
+
+class Offload:
+    """Producer end of an offload stage
+
+    Use open_offload to make one.
+    """
+
+    def __init__(self, send_channel):
+        self._send_channel = send_channel
+        self.sent = 0
+        self.processed = 0  # bytes that fn has finished with
+
+    async def send(self, chunk):
+        await self._send_channel.send(chunk)
+        self.sent += len(chunk)
+
+
+def take_batch(receive_channel, first, max_batch):
+    """Return [first] plus whatever else is already queued, up to max_batch items
+
+    So one thread hop can handle everything that piled up while the last one ran.
+    """
+    batch = [first]
+    while len(batch) < max_batch:
+        try:
+            batch.append(receive_channel.receive_nowait())
+        except (trio.WouldBlock, trio.EndOfChannel):
+            break
+    return batch
+
+
+def _run_batch(fn, batch):
+    return [fn(chunk) for chunk in batch]
+
+
+async def _drain_in_thread(stage, fn, receive_channel, on_result, max_batch):
+    async with receive_channel:
+        async for chunk in receive_channel:
+            batch = take_batch(receive_channel, chunk, max_batch)
+            results = await to_thread(_run_batch, fn, batch)
+            for chunk, result in zip(batch, results):
+                stage.processed += len(chunk)
+                if on_result is not None:
+                    on_result(result)
+
+
+async def _drain_to_executor(stage, fn, receive_channel, on_result, executor, max_pending):
+    pending = collections.deque()
+
+    async def finish_oldest():
+        nbytes, fut = pending.popleft()
+        result = await wait_future(fut)
+        stage.processed += nbytes
+        if on_result is not None:
+            on_result(result)
+
+    async with receive_channel:
+        async for chunk in receive_channel:
+            if len(pending) >= max_pending:
+                await finish_oldest()
+            pending.append((len(chunk), executor.submit(fn, chunk)))
+        while pending:
+            await finish_oldest()
+
+
+@asynccontextmanager
+async def open_offload(fn, on_result=None, executor=None, max_buffer=16, max_pending=4, max_batch=64):
+    """Yield an Offload that calls fn(chunk) in a worker for every chunk sent
+
+    On exit, wait until every chunk has been processed.
+    """
+    send_channel, receive_channel = trio.open_memory_channel(max_buffer)
+    async with trio.open_nursery() as nursery:
+        stage = Offload(send_channel)
+        if executor is None:
+            nursery.start_soon(_drain_in_thread, stage, fn, receive_channel, on_result, max_batch)
+        else:
+            nursery.start_soon(
+                _drain_to_executor, stage, fn, receive_channel, on_result, executor, max_pending
+            )
+        async with send_channel:
+            yield stage
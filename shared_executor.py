@@ -0,0 +1,205 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" One bounded, metered thread pool for both asyncio and its Trio guest
+
+With Trio as a guest of asyncio there are normally separate thread
+populations: asyncio's default executor, Trio's to_thread worker cache and the
+guest I/O thread. MeteredExecutor is a ThreadPoolExecutor that keeps count of
+what goes through it. AioHost(loop, executor=...) makes it the loop's default
+executor, so loop.run_in_executor(None, ...) uses it, and registers it for the
+loop so that to_thread(fn, *args) in a guest task sends work to the same pool.
+FileSink, the offload stage and the HTTP cache in example_tasks all use it.
+
+to_thread falls back to trio.to_thread.run_sync when no executor is registered.
+
+What still calls trio.to_thread.run_sync directly (Trio's own getaddrinfo,
+trio.open_file) runs in Trio's thread cache. Start the guest with
+run_guest(task, ...) to size Trio's default thread limiter to the pool, so that
+side is held to max_workers threads at once as well. Run with threadless=True
+to get rid of the I/O thread too.
+
+Importing this module loads neither asyncio nor concurrent.futures, so hosts
+other than asyncio pay nothing for the guest-side to_thread path.
+"""
+import sys
+import threading
+import time
+from functools import lru_cache, partial
+
+import outcome
+import trio
+
+# asyncio loop -> MeteredExecutor, filled in by AioHost
+_executors = {}
+
+
+@lru_cache(maxsize=None)
+def _metered_executor_class():
+    """Define MeteredExecutor on first use
+
+    A function so that importing this module doesn't import concurrent.futures.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    class MeteredExecutor(ThreadPoolExecutor):
+        def __init__(self, max_workers=None, thread_name_prefix="shared"):
+            super().__init__(max_workers, thread_name_prefix)
+            self._lock = threading.Lock()
+            self.created = time.perf_counter()
+            self.submitted = 0
+            self.started = 0
+            self.cancelled = 0  # cancelled before a worker picked them up
+            self.completed = 0
+            self.busy_time = 0.0
+            self.max_queue_depth = 0
+
+        def submit(self, fn, /, *args, **kwargs):
+            with self._lock:
+                self.submitted += 1
+                depth = self.submitted - self.started - self.cancelled
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+            fut = super().submit(self._metered, fn, args, kwargs)
+            fut.add_done_callback(self._count_cancelled)
+            return fut
+
+        def _count_cancelled(self, fut):
+            # a cancelled job never reaches _metered, so it has to leave the
+            # queue here
+            if fut.cancelled():
+                with self._lock:
+                    self.cancelled += 1
+
+        def _metered(self, fn, args, kwargs):
+            with self._lock:
+                self.started += 1
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                busy = time.perf_counter() - start
+                with self._lock:
+                    self.completed += 1
+                    self.busy_time += busy
+
+        @property
+        def queue_depth(self):
+            """Jobs submitted but not yet picked up by a worker or cancelled"""
+            return self.submitted - self.started - self.cancelled
+
+        def metrics(self):
+            with self._lock:
+                elapsed = time.perf_counter() - self.created
+                return {
+                    "max_workers": self._max_workers,
+                    "threads": len(self._threads),
+                    "submitted": self.submitted,
+                    "queue_depth": self.submitted - self.started - self.cancelled,
+                    "cancelled": self.cancelled,
+                    "max_queue_depth": self.max_queue_depth,
+                    "running": self.started - self.completed,
+                    "completed": self.completed,
+                    "busy_time": self.busy_time,
+                    # fraction of worker capacity in use since the pool was made
+                    "utilization": self.busy_time / (elapsed * self._max_workers),
+                }
+
+    return MeteredExecutor
+
+
+def __getattr__(name):
+    if name == "MeteredExecutor":
+        return _metered_executor_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def wait_future(fut):
+    """Wait for a concurrent.futures.Future without tying up a thread
+
+    If we are cancelled, the future is cancelled too if it hasn't started yet.
+    Otherwise the cancellation waits for it to finish.
+    """
+    task = trio.lowlevel.current_task()
+    token = trio.lowlevel.current_trio_token()
+    aborted = False
+
+    def deliver():
+        if not aborted:
+            trio.lowlevel.reschedule(task, outcome.capture(fut.result))
+
+    def abort(raise_cancel):
+        nonlocal aborted
+        if fut.cancel():
+            aborted = True
+            return trio.lowlevel.Abort.SUCCEEDED
+        return trio.lowlevel.Abort.FAILED
+
+    # Done callbacks run in whatever thread finished the future
+    fut.add_done_callback(lambda fut: token.run_sync_soon(deliver))
+    return await trio.lowlevel.wait_task_rescheduled(abort)
+
+
+def install(loop, executor):
+    """Make executor the default for loop and for to_thread in guest tasks on it"""
+    loop.set_default_executor(executor)
+    _executors[loop] = executor
+
+
+def uninstall(loop):
+    _executors.pop(loop, None)
+
+
+def current_executor():
+    """The executor registered for the running asyncio loop, if any"""
+    # Only a running asyncio loop can have one, and if asyncio was never
+    # imported there is no loop to look up
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    return _executors.get(loop)
+
+
+def limit_trio_threads():
+    """Size Trio's default thread limiter to the registered pool, if there is one
+
+    The limiter belongs to the run, so this has to be called from inside it.
+    """
+    executor = current_executor()
+    if executor is not None:
+        trio.to_thread.current_default_thread_limiter().total_tokens = executor._max_workers
+
+
+async def run_guest(async_fn, *args):
+    """Guest entry point: limit_trio_threads(), then run async_fn(*args)"""
+    limit_trio_threads()
+    return await async_fn(*args)
+
+
+async def to_thread(fn, *args):
+    """Run fn(*args) in the shared executor, or in a Trio worker thread if none
+
+    Guest ticks run inside asyncio callbacks, so the running loop tells us which
+    executor to use. If cancelled before a worker picks the job up, it is
+    dropped. Otherwise cancellation waits for it to finish.
+    """
+    executor = current_executor()
+    if executor is None:
+        return await trio.to_thread.run_sync(partial(fn, *args))
+    return await wait_future(executor.submit(fn, *args))
@@ -0,0 +1,272 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Show progress from another process through shared memory
+
+A display is normally called right inside Trio tasks, so a slow redraw slows
+the transfer and vice versa. SharedMemoryDisplay just packs value, maximum
+and title into a multiprocessing.shared_memory block, and never blocks. A GUI
+in another process reads the block with SharedMemoryReader.poll at its own frame
+rate and passes any changes on to a real display. If the GUI lags or dies, the
+transfer doesn't notice.
+
+The block is a seqlock. The writer makes the sequence number odd, writes the
+fields, then makes it even again. A reader retries if the sequence was odd or
+changed while it read, so it never sees a torn update. The title is only copied
+out when its id changes. A cancel flag outside the seqlock goes the other way:
+the GUI sets it and the writer polls it from a Trio system task.
+
+main(task) runs task with plain trio.run in this process, and the GUI (tk or
+tqdm) in a child process.
+
+Usage: python shm_display.py [--gui {tk,tqdm}]
+"""
+import argparse
+import os
+import struct
+import subprocess
+import sys
+import time
+from multiprocessing import shared_memory
+
+import trio
+
+SEQ = struct.Struct("<Q")
+# value, maximum, title id, closed flag, title length
+FIELDS = struct.Struct("<qqQBxH")
+FIELDS_OFFSET = SEQ.size
+CANCEL_OFFSET = FIELDS_OFFSET + FIELDS.size
+TITLE_OFFSET = CANCEL_OFFSET + 1
+TITLE_BYTES = 512
+SIZE = TITLE_OFFSET + TITLE_BYTES
+# blocks created by SharedMemoryDisplays in this process
+_created = set()
+
+
+class SharedMemoryDisplay:
+    """Writer end: a display that only writes to shared memory"""
+
+    def __init__(self, name=None, cancel_poll=0.1):
+        self.shm = shared_memory.SharedMemory(name, create=True, size=SIZE)
+        self.name = self.shm.name
+        _created.add(self.name)
+        self._buf = self.shm.buf
+        self._buf[:SIZE] = bytes(SIZE)
+        self._seq = 0
+        self.value = 0
+        self.maximum = 0
+        self._title = b""
+        self._title_id = 0
+        self._closed = 0
+        self.cancel_poll = cancel_poll
+
+    def _publish(self, title_changed=False):
+        buf = self._buf
+        SEQ.pack_into(buf, 0, self._seq + 1)
+        FIELDS.pack_into(
+            buf,
+            FIELDS_OFFSET,
+            self.value,
+            self.maximum,
+            self._title_id,
+            self._closed,
+            len(self._title),
+        )
+        if title_changed:
+            buf[TITLE_OFFSET : TITLE_OFFSET + len(self._title)] = self._title
+        self._seq += 2
+        SEQ.pack_into(buf, 0, self._seq)
+
+    def set_title(self, title):
+        self._title = title.encode()[:TITLE_BYTES]
+        self._title_id += 1
+        self._publish(title_changed=True)
+
+    def set_max(self, maximum):
+        self.maximum = maximum
+        self._publish()
+
+    def set_value(self, downloaded):
+        self.value = downloaded
+        self._publish()
+
+    def set_cancel(self, fn):
+        try:
+            trio.lowlevel.spawn_system_task(self._watch_cancel, fn, name="SharedMemoryDisplay cancel")
+        except RuntimeError:
+            pass  # not in Trio, so nothing to poll with
+
+    async def _watch_cancel(self, fn):
+        while self._buf is not None:
+            if self._buf[CANCEL_OFFSET]:
+                self._buf[CANCEL_OFFSET] = 0
+                fn()
+                return
+            await trio.sleep(self.cancel_poll)
+
+    def close(self):
+        """Tell readers we're done, and detach"""
+        self._closed = 1
+        self._publish()
+        self._buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+        _created.discard(self.name)
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 the resource tracker would unlink the block when
+        # this process exits, out from under the writer. Unless the writer is
+        # in this process too, in which case the registration is its own.
+        shm = shared_memory.SharedMemory(name)
+        if os.name == "posix" and name not in _created:
+            from multiprocessing import resource_tracker
+
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedMemoryReader:
+    """GUI end: poll a SharedMemoryDisplay's block and pass changes to a display"""
+
+    def __init__(self, name):
+        self.shm = _attach(name)
+        self._buf = self.shm.buf
+        self.seq = 0
+        self.value = 0
+        self.maximum = 0
+        self.title = ""
+        self.title_id = 0
+        self.closed = False
+
+    def read(self, attempts=100):
+        """Update our copy of the fields; False if the writer kept us out"""
+        buf = self._buf
+        for _ in range(attempts):
+            (seq,) = SEQ.unpack_from(buf, 0)
+            if seq & 1:
+                continue
+            value, maximum, title_id, closed, title_len = FIELDS.unpack_from(buf, FIELDS_OFFSET)
+            title = None
+            if title_id != self.title_id:
+                title = bytes(buf[TITLE_OFFSET : TITLE_OFFSET + min(title_len, TITLE_BYTES)])
+            if SEQ.unpack_from(buf, 0)[0] != seq:
+                continue
+            self.seq, self.value, self.maximum, self.closed = seq, value, maximum, bool(closed)
+            if title is not None:
+                self.title_id = title_id
+                self.title = title.decode(errors="ignore")
+            return True
+        return False
+
+    def poll(self, display):
+        """Read the block and call display for whatever changed since last time
+
+        Returns False once the writer has closed the block.
+        """
+        old = self.seq, self.title_id, self.maximum, self.value
+        if self.read() and self.seq != old[0]:
+            if self.title_id != old[1]:
+                display.set_title(self.title)
+            if self.maximum != old[2]:
+                display.set_max(self.maximum)
+            if self.value != old[3]:
+                display.set_value(self.value)
+        return not self.closed
+
+    def request_cancel(self):
+        self._buf[CANCEL_OFFSET] = 1
+
+    def close(self):
+        self._buf = None
+        self.shm.close()
+
+
+def poll_tk(root, reader, display, fps=30):
+    """Poll reader from root's event loop, destroying root when the writer closes"""
+
+    def tick():
+        if reader.poll(display):
+            root.after(int(1000 / fps), tick)
+        else:
+            root.destroy()
+
+    display.set_cancel(reader.request_cancel)
+    tick()
+
+
+def gui_main(name, gui="tk", fps=30):
+    """Run a GUI in this process showing the SharedMemoryDisplay called name"""
+    reader = SharedMemoryReader(name)
+    try:
+        if gui == "tk":
+            import tkinter as tk
+
+            from trio_guest_tkinter import TkDisplay
+
+            root = tk.Tk()
+            poll_tk(root, reader, TkDisplay(root), fps)
+            root.mainloop()
+        else:
+            from trio_guest_asyncio import TqdmDisplay
+
+            display = TqdmDisplay()
+            while reader.poll(display):
+                time.sleep(1 / fps)
+            display.pbar.close()
+    finally:
+        reader.close()
+
+
+def main(task, gui="tk", fps=30, grace=5):
+    """Run task here with plain trio.run, showing its progress from a GUI process
+
+    Once the task is done, the GUI gets grace seconds to notice and exit.
+    """
+    display = SharedMemoryDisplay()
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--reader", display.name]
+        process = subprocess.Popen(command + ["--gui", gui, "--fps", str(fps)])
+        try:
+            result = trio.run(task, display)
+        finally:
+            display.close()
+            try:
+                process.wait(grace)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    finally:
+        display.unlink()
+    print(f"Outcome: {result}")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument("--gui", choices=("tk", "tqdm"), default="tk")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--reader", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.reader:
+        gui_main(args.reader, args.gui, args.fps)
+    else:
+        import example_tasks
+
+        main(example_tasks.count, args.gui, args.fps)
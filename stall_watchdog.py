@@ -0,0 +1,201 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Log what the host thread is doing when Trio thunks stop running
+
+A long GUI callback, a modal loop (like dragging a Win32 window), or a guest
+task that doesn't checkpoint all block the host loop, and with it the whole
+Trio guest. StallWatchdog wraps a host's run_sync_soon_* methods like
+host_metrics.HostMetrics does, and a watchdog thread checks them every interval.
+A stall is either of:
+
+- a scheduled thunk that has waited more than threshold seconds, meaning the
+  host is stuck in something of its own, or
+- a thunk (a guest tick) that has been running more than threshold seconds,
+  meaning a Trio task is hogging the loop.
+
+Each stall is logged once, with the host thread's stack from
+sys._current_frames(), then again when it clears.
+
+Run this module to see it catch a task calling time.sleep on asyncio.
+"""
+import inspect
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class StallWatchdog:
+    def __init__(self, threshold=1.0, interval=None):
+        self.threshold = threshold
+        self.interval = threshold / 4 if interval is None else interval
+        self.host_thread_id = None
+        self.stalls = 0
+        # maps a token to when it was scheduled; dicts keep insertion order so
+        # the first entry is the oldest
+        self._pending = {}
+        self._tokens = itertools.count()  # next() is atomic, unlike +=
+        self._running = None  # (func, start time) of the thunk being run
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def instrument(self, host):
+        """Wrap host's run_sync_soon_* methods in place and return host
+
+        Call this from the host thread, which is the one we will watch.
+        """
+        self.host_thread_id = threading.get_ident()
+        for name in ("run_sync_soon_threadsafe", "run_sync_soon_not_threadsafe"):
+            schedule = getattr(host, name, None)
+            if schedule is not None:
+                setattr(host, name, self.wrap(schedule))
+        return host
+
+    def wrap(self, schedule):
+        """Return a watched version of a run_sync_soon_* function"""
+        pending = self._pending
+        perf_counter = time.perf_counter
+
+        def run_sync_soon(func):
+            token = next(self._tokens)
+            pending[token] = perf_counter()
+
+            def watched():
+                pending.pop(token, None)
+                self._running = func, perf_counter()
+                try:
+                    func()
+                finally:
+                    self._running = None
+
+            schedule(watched)
+
+        return run_sync_soon
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name="StallWatchdog", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _oldest_pending(self):
+        try:
+            return next(iter(self._pending.values()))
+        except (StopIteration, RuntimeError):
+            # empty, or mutated by the host under our feet; try again next time
+            return None
+
+    def _watch(self):
+        stalled_since = None
+        while not self._stopped.wait(self.interval):
+            now = time.perf_counter()
+            running = self._running
+            oldest = self._oldest_pending()
+            if running is not None and now - running[1] > self.threshold:
+                since = running[1]
+            elif oldest is not None and now - oldest > self.threshold:
+                since = oldest
+            else:
+                if stalled_since is not None:
+                    logger.warning("Host loop recovered after %.3f s", now - stalled_since)
+                    stalled_since = None
+                continue
+            if stalled_since is None:
+                stalled_since = since
+                self.stalls += 1
+                logger.warning(self.describe(now, running, oldest))
+
+    def describe(self, now, running, oldest):
+        frame = sys._current_frames().get(self.host_thread_id)
+        lines = []
+        if running is not None:
+            func, start = running
+            lines.append(f"Host loop stalled: thunk {func!r} has been running {now - start:.3f} s")
+            task_frame = _innermost_coroutine_frame(frame)
+            if task_frame is not None:
+                code = task_frame.f_code
+                lines.append(
+                    f"Guest task is in {code.co_name} ({code.co_filename}:{task_frame.f_lineno})"
+                )
+        else:
+            lines.append(
+                f"Host loop stalled: a thunk has waited {now - oldest:.3f} s to run, "
+                f"{len(self._pending)} waiting"
+            )
+        if frame is None:
+            lines.append("Host thread not found")
+        else:
+            lines.append("Host thread stack (most recent call last):")
+            lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        return "\n".join(lines)
+
+
+def _innermost_coroutine_frame(frame):
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return frame
+        frame = frame.f_back
+    return None
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    import trio
+
+    from trio_guest_asyncio import AioHost, TqdmDisplay
+
+    async def hog(display):
+        display.set_title("Blocking the host loop for 2 seconds...")
+        await trio.sleep(0.5)
+        time.sleep(2)
+        await trio.sleep(0.5)
+        return 1
+
+    async def amain():
+        watchdog = StallWatchdog(threshold=0.5)
+        host = watchdog.instrument(AioHost(asyncio.get_running_loop()))
+        display = TqdmDisplay()
+        with watchdog:
+            trio.lowlevel.start_guest_run(
+                hog,
+                display,
+                run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+                run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+                done_callback=host.done_callback,
+                host_uses_signal_set_wakeup_fd=True,
+            )
+            await host.done_fut
+        display.pbar.close()
+
+    logging.basicConfig()
+    asyncio.run(amain())
@@ -0,0 +1,322 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Spread a batch of tasks over worker processes with one display
+
+One guest run is capped at one core. open_worker_pool starts nworkers copies
+of this script with --worker. Each one runs its own AioHost and Trio guest and
+takes up to per_worker jobs at a time. A job names a task from TASKS and gives
+its keyword arguments. Messages are JSON, one per line, over the worker's stdin
+and stdout:
+
+- parent to worker: {"id": 3, "task": "get", "kwargs": {...}}, {"cancel": 3}
+- worker to parent: {"progress": {"3": [title, maximum, value], ...}},
+  batched every 1/fps seconds, then one of {"id": 3, "result": ...},
+  {"id": 3, "error": "..."} or {"id": 3, "cancelled": true}
+
+WorkerPool.run(display, name, kwargs) forwards a job's progress to display, so
+supervise can hand the jobs to dashboard.run_dashboard and show everything in
+one UI.
+
+Usage: python supervisor.py [--workers N] [--read-size BYTES] URL [URL...]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import traceback
+from contextlib import asynccontextmanager
+from functools import partial
+
+import outcome
+import trio
+
+import dashboard
+import example_tasks
+
+TASKS = {
+    "get": example_tasks.get,
+    "sha256": example_tasks.sha256,
+    "count": example_tasks.count,
+}
+
+
+##########################################
+### Worker side                        ###
+##########################################
+
+
+async def worker(display, proto_out, fps=10):
+    """Guest task of a worker process: run jobs from stdin until it closes"""
+    out = trio.wrap_file(proto_out)
+    send_lock = trio.Lock()
+    dirty = set()
+    scopes = {}
+
+    async def send(message):
+        async with send_lock:
+            await out.write(json.dumps(message).encode() + b"\n")
+            await out.flush()
+
+    async def send_progress():
+        if dirty:
+            rows = {row.index: [row.title, row.maximum, row.value] for row in dirty}
+            dirty.clear()
+            await send({"progress": rows})
+
+    async def run_job(job_id, name, kwargs):
+        row = dashboard.Row(job_id, dirty)
+        message = {"id": job_id, "cancelled": True}
+        with trio.CancelScope() as scopes[job_id]:
+            try:
+                message = {"id": job_id, "result": await TASKS[name](row, **kwargs)}
+            except Exception as exc:
+                traceback.print_exc()
+                message = {"id": job_id, "error": f"{type(exc).__name__}: {exc}"}
+        del scopes[job_id]
+        await send_progress()
+        await send(message)
+
+    async def progress_loop():
+        while True:
+            await trio.sleep(1 / fps)
+            await send_progress()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(progress_loop)
+        async with trio.open_nursery() as jobs:
+            async for line in trio.wrap_file(sys.stdin.buffer):
+                message = json.loads(line)
+                if "cancel" in message:
+                    scope = scopes.get(message["cancel"])
+                    if scope is not None:
+                        scope.cancel()
+                else:
+                    jobs.start_soon(run_job, message["id"], message["task"], message["kwargs"])
+        nursery.cancel_scope.cancel()
+
+
+async def _worker_amain(proto_out):
+    from trio_guest_asyncio import AioHost
+
+    host = AioHost(asyncio.get_running_loop())
+    trio.lowlevel.start_guest_run(
+        worker,
+        None,
+        proto_out,
+        run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
+        run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
+        done_callback=host.done_callback,
+        host_uses_signal_set_wakeup_fd=True,
+    )
+    (await host.done_fut).unwrap()
+
+
+def worker_main():
+    # Keep the real stdout for messages, and send the tasks' chatter to devnull
+    proto_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    asyncio.run(_worker_amain(proto_out))
+
+
+##########################################
+### Parent side                        ###
+##########################################
+
+
+class _Job:
+    def __init__(self, display):
+        self.display = display
+        self.done = trio.Event()
+        self.outcome = None
+
+
+class _Worker:
+    def __init__(self, process):
+        self.process = process
+        self.jobs = {}
+        self._send_lock = trio.Lock()
+
+    async def send(self, message):
+        async with self._send_lock:
+            await self.process.stdin.send_all(json.dumps(message).encode() + b"\n")
+
+    async def read_loop(self):
+        buffer = bytearray()
+        try:
+            async for data in self.process.stdout:
+                buffer += data
+                *lines, buffer[:] = buffer.split(b"\n")
+                for line in lines:
+                    self._handle(json.loads(line))
+        finally:
+            for job in self.jobs.values():
+                job.outcome = outcome.Error(RuntimeError("worker process exited"))
+                job.done.set()
+
+    def _handle(self, message):
+        if "progress" in message:
+            for job_id, (title, maximum, value) in message["progress"].items():
+                job = self.jobs.get(int(job_id))
+                if job is not None:
+                    job.display.set_title(title)
+                    job.display.set_max(maximum)
+                    job.display.set_value(value)
+            return
+        job = self.jobs.get(message["id"])
+        if job is None:
+            return
+        if "result" in message:
+            job.outcome = outcome.Value(message["result"])
+        elif "error" in message:
+            job.outcome = outcome.Error(RuntimeError(message["error"]))
+        else:
+            job.outcome = outcome.Value(None)
+        job.done.set()
+
+
+class WorkerPool:
+    """Parent end of a pool of worker processes
+
+    Use open_worker_pool to make one.
+    """
+
+    def __init__(self, workers, per_worker):
+        self.workers = workers
+        self.capacity = len(workers) * per_worker
+        self._slots_send, self._slots = trio.open_memory_channel(self.capacity)
+        for _ in range(per_worker):
+            for worker in workers:
+                self._slots_send.send_nowait(worker)
+        self._ids = itertools.count()
+
+    async def run(self, display, name, kwargs):
+        """Run TASKS[name](display, **kwargs) in a worker and return its result
+
+        Waits for a free slot if every worker is busy. If cancelled, the job is
+        cancelled in the worker too, and the slot is only given back once the
+        worker says the job has stopped (or after a second, at most).
+        """
+        worker = await self._slots.receive()
+        job_id = next(self._ids)
+        job = worker.jobs[job_id] = _Job(display)
+        try:
+            await worker.send({"id": job_id, "task": name, "kwargs": kwargs})
+            try:
+                await job.done.wait()
+            except trio.Cancelled:
+                with trio.move_on_after(1) as cleanup:
+                    cleanup.shield = True
+                    await worker.send({"cancel": job_id})
+                    await job.done.wait()
+                raise
+            return job.outcome.unwrap()
+        finally:
+            del worker.jobs[job_id]
+            self._slots_send.send_nowait(worker)
+
+
+@asynccontextmanager
+async def open_worker_pool(nworkers=None, per_worker=4, grace=5):
+    """Start nworkers worker processes (default one per core) and yield a WorkerPool
+
+    On exit, close the workers' stdin and give them grace seconds to finish
+    before killing them.
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    command = [sys.executable, os.path.abspath(__file__), "--worker"]
+    workers = []
+    async with trio.open_nursery() as nursery:
+        try:
+            for _ in range(nworkers):
+                process = await trio.lowlevel.open_process(
+                    command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+                )
+                workers.append(_Worker(process))
+                nursery.start_soon(workers[-1].read_loop)
+            yield WorkerPool(workers, per_worker)
+        finally:
+            with trio.CancelScope(shield=True):
+                for worker in workers:
+                    await worker.process.stdin.aclose()
+                with trio.move_on_after(grace):
+                    for worker in workers:
+                        await worker.process.wait()
+                for worker in workers:
+                    if worker.process.returncode is None:
+                        worker.process.kill()
+                        await worker.process.wait()
+
+
+class _NullBoard:
+    def add_rows(self, rows):
+        pass
+
+    def update_rows(self, rows):
+        pass
+
+
+async def supervise(display, jobs, make_board=None, nworkers=None, per_worker=4):
+    """Run jobs, a list of (task name, kwargs) pairs, across worker processes
+
+    Overall progress goes to display, and each job to a row on the board from
+    make_board if given.
+    """
+    async with open_worker_pool(nworkers, per_worker) as pool:
+        tasks = [partial(pool.run, name=name, kwargs=kwargs) for name, kwargs in jobs]
+        return await dashboard.run_dashboard(
+            display,
+            tasks,
+            make_board or (lambda display: _NullBoard()),
+            limit=pool.capacity,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument("urls", nargs="*")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--per-worker", type=int, default=4, help="jobs per worker at once")
+    parser.add_argument(
+        "--read-size", type=int, default=100_000, help="bytes per socket read (set_read_size)"
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        worker_main()
+        return
+
+    import trio_guest_asyncio
+
+    jobs = [("get", {"url": url, "read_size": args.read_size}) for url in args.urls]
+    trio_guest_asyncio.main(
+        partial(
+            supervise,
+            jobs=jobs,
+            make_board=trio_guest_asyncio.TqdmBoard,
+            nworkers=args.workers,
+            per_worker=args.per_worker,
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Rate limit any display so tasks can report progress as often as they like
+"""
+import time
+
+import trio
+
+
+class ThrottledDisplay:
+    """Coalesce set_title/set_max/set_value calls on another display to a frame rate
+
+    Calls are stored and only the latest of each kind is passed on, at most fps
+    times per second. When a call is held back, a Trio system task wakes up at
+    the next frame to pass it on, so the final value always reaches the display,
+    even if the run ends first. If the wrapped display raises during one of those
+    late flushes, the exception is raised from the task's next call instead.
+
+    The rate adapts to the host loop. Each frame we measure how late that system
+    task woke up and how long the wrapped display took. If together they use
+    more than budget of the frame time, the rate halves, down to min_fps. If
+    they use less than a quarter of that, the rate creeps back up to fps.
+    """
+
+    def __init__(self, display, fps=60, min_fps=4, budget=0.5):
+        self.display = display
+        self.target_fps = fps
+        self.min_fps = min_fps
+        self.budget = budget
+        self.fps = fps
+        self._pending = {}
+        self._next_frame = 0
+        self._trailing = False
+        self._error = None
+
+    def set_title(self, title):
+        self._update("set_title", title)
+
+    def set_max(self, maximum):
+        self._update("set_max", maximum)
+
+    def set_value(self, downloaded):
+        self._update("set_value", downloaded)
+
+    def set_cancel(self, fn):
+        self.display.set_cancel(fn)
+
+    def _update(self, name, arg):
+        self._raise_deferred()
+        self._pending[name] = arg
+        now = time.perf_counter()
+        if now >= self._next_frame:
+            self._adapt(self._flush(now))
+        elif not self._trailing:
+            try:
+                trio.lowlevel.spawn_system_task(self._flush_later, name="ThrottledDisplay flush")
+            except RuntimeError:
+                # not in Trio, nothing can flush later
+                self._flush(now)
+            else:
+                self._trailing = True
+
+    def flush(self):
+        """Pass any held back calls to the display right now"""
+        self._raise_deferred()
+        if self._pending:
+            self._flush(time.perf_counter())
+
+    def _flush(self, now):
+        """Returns the time spent in the wrapped display"""
+        pending, self._pending = self._pending, {}
+        # max before value so the value is drawn against the right scale
+        for name in ("set_title", "set_max", "set_value"):
+            if name in pending:
+                getattr(self.display, name)(pending[name])
+        self._next_frame = now + 1 / self.fps
+        return time.perf_counter() - now
+
+    def _raise_deferred(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _adapt(self, load):
+        frame_time = 1 / self.fps
+        if load > self.budget * frame_time:
+            self.fps = max(self.min_fps, self.fps / 2)
+        elif load < self.budget * frame_time / 4:
+            self.fps = min(self.target_fps, self.fps * 1.25)
+
+    async def _flush_later(self):
+        deadline = self._next_frame
+        try:
+            await trio.sleep(max(0, deadline - time.perf_counter()))
+        finally:
+            self._trailing = False
+            if self._pending:
+                now = time.perf_counter()
+                try:
+                    cost = self._flush(now)
+                except Exception as exc:
+                    # escaping a system task would crash the whole run
+                    self._error = exc
+                else:
+                    self._adapt(max(0, now - deadline) + cost)
@@ -15,19 +15,32 @@
 # limitations under the License.
 #
 import traceback
+from functools import partial
 
-import trio
 import asyncio
 from outcome import Error
 
+import dashboard
 import example_tasks
-import tqdm
+import shared_executor
+import trio_threadless
 
 
 class AioHost:
-    def __init__(self, loop):
+    def __init__(self, loop, executor=None):
+        """Host a Trio guest on an asyncio loop
+
+        If executor is given (see shared_executor.MeteredExecutor), it becomes the
+        loop's default executor and the pool used by shared_executor.to_thread in
+        guest tasks (FileSink, offload and the HTTP cache go through it), until the
+        guest run is done. Start the guest with shared_executor.run_guest to cap
+        what still uses trio.to_thread.run_sync at the same size.
+        """
         self.loop = loop
         self.done_fut = asyncio.Future()
+        self.executor = executor
+        if executor is not None:
+            shared_executor.install(loop, executor)
 
     def run_sync_soon_threadsafe(self, func):
         self.loop.call_soon_threadsafe(func)
@@ -35,7 +48,20 @@ class AioHost:
     def run_sync_soon_not_threadsafe(self, func):
         self.loop.call_soon(func)
 
+    def wait_readable(self, fd, timeout, callback):
+        """Call callback once fd is readable or timeout expires, for trio_threadless"""
+
+        def fire():
+            self.loop.remove_reader(fd)
+            timer.cancel()
+            callback()
+
+        self.loop.add_reader(fd, fire)
+        timer = self.loop.call_later(timeout, fire)
+
     def done_callback(self, outcome):
+        if self.executor is not None:
+            shared_executor.uninstall(self.loop)
         print(f"Outcome: {outcome}")
         if isinstance(outcome, Error):
             exc = outcome.error
@@ -43,8 +69,24 @@ class AioHost:
         self.done_fut.set_result(outcome)
 
 
+async def ticker(period, samples, stopped, on_tick=None):
+    """Append how late each asyncio.sleep(period) wakes up to samples until stopped
+
+    on_tick(), if given, is called after every sample.
+    """
+    loop = asyncio.get_running_loop()
+    while not stopped.is_set():
+        target = loop.time() + period
+        await asyncio.sleep(period)
+        samples.append(loop.time() - target)
+        if on_tick is not None:
+            on_tick()
+
+
 class TqdmDisplay:
     def __init__(self):
+        import tqdm
+
         self.pbar = tqdm.tqdm(unit='Bytes', unit_scale=1)
         self.prev_downloaded = 0
 
@@ -63,24 +105,82 @@ class TqdmDisplay:
         pass
 
 
-async def amain(task):
-    host = AioHost(asyncio.get_running_loop())
+class TqdmBoard:
+    """A tqdm bar per running dashboard task, below the overall bar
+
+    A terminal can't hold hundreds of bars, so only running tasks get one, and a
+    finished task hands its screen position to the next.
+    """
+
+    def __init__(self, display):
+        import tqdm
+
+        self._tqdm = tqdm.tqdm
+        self.bars = {}  # row index -> (bar, position)
+        self.free_positions = []
+        self.next_position = 1  # the host display has position 0
+
+    def add_rows(self, rows):
+        pass
+
+    def update_rows(self, rows):
+        for row in rows:
+            if row.state != dashboard.RUNNING:
+                if row.index in self.bars:
+                    bar, position = self.bars.pop(row.index)
+                    bar.close()
+                    self.free_positions.append(position)
+                continue
+            if row.index in self.bars:
+                bar, position = self.bars[row.index]
+            else:
+                if self.free_positions:
+                    position = self.free_positions.pop()
+                else:
+                    position = self.next_position
+                    self.next_position += 1
+                bar = self._tqdm(position=position, leave=False, unit='B', unit_scale=1)
+                self.bars[row.index] = bar, position
+            bar.total = row.maximum or None
+            bar.n = row.value
+            bar.set_description(row.title, refresh=False)
+            bar.refresh()
+
+
+async def amain(task, threadless=False, max_workers=None):
+    """Run task as a guest of the running loop
+
+    With max_workers, asyncio and the guest share one MeteredExecutor of that size,
+    and Trio's own worker threads are capped at the same size.
+    """
+    executor = None if max_workers is None else shared_executor.MeteredExecutor(max_workers)
+    host = AioHost(asyncio.get_running_loop(), executor)
     display = TqdmDisplay()
-    trio.lowlevel.start_guest_run(
+    trio_threadless.start_guest_run(
+        shared_executor.run_guest,
         task,
         display,
         run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
         run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
         done_callback=host.done_callback,
         host_uses_signal_set_wakeup_fd=True,
+        wait_readable=host.wait_readable if threadless else None,
     )
     outcome = await host.done_fut
     display.pbar.close()
     return outcome.unwrap()
 
 
-def main(task):
-    asyncio.run(amain(task))
+def main(task, threadless=False, max_workers=None):
+    asyncio.run(amain(task, threadless, max_workers))
+
+
+def dashboard_main(tasks, limit=10, threadless=False):
+    """Run many tasks at once, each with a tqdm bar while it runs"""
+    main(
+        partial(dashboard.run_dashboard, tasks=tasks, make_board=TqdmBoard, limit=limit),
+        threadless=threadless,
+    )
 
 
 if __name__ == '__main__':
@@ -14,10 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import math
 import traceback
 from functools import wraps
 
-import trio
 from gi import require_version
 
 require_version("Gtk", "3.0")
@@ -25,6 +25,7 @@ from gi.repository import Gtk, GLib
 from outcome import Error
 
 import example_tasks
+import trio_threadless
 
 
 class GtkHost:
@@ -33,6 +34,22 @@ class GtkHost:
         # Trio guest ticks return None which is good enough
         GLib.idle_add(fn)
 
+    def wait_readable(self, fd, timeout, callback):
+        """Call callback once fd is readable or timeout expires, for trio_threadless"""
+
+        def on_fd(*args):
+            GLib.source_remove(timer)
+            callback()
+            return False
+
+        def on_timeout():
+            GLib.source_remove(watch)
+            callback()
+            return False
+
+        watch = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, fd, GLib.IOCondition.IN, on_fd)
+        timer = GLib.timeout_add(max(1, math.ceil(timeout * 1000)), on_timeout)
+
     def done_callback(self, outcome):
         print(f"Outcome: {outcome}")
         if isinstance(outcome, Error):
@@ -74,15 +91,16 @@ class GtkDisplay:
         self.window.connect("destroy", ignore_args)
 
 
-def main(task):
+def main(task, threadless=False):
     host = GtkHost()
     display = GtkDisplay()
-    trio.lowlevel.start_guest_run(
+    trio_threadless.start_guest_run(
         task,
         display,
         run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
         done_callback=host.done_callback,
         host_uses_signal_set_wakeup_fd=True,
+        wait_readable=host.wait_readable if threadless else None,
     )
     host.mainloop()
 
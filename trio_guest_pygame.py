@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
+import time
 import traceback
 
 import trio
@@ -25,33 +27,52 @@ import example_tasks
 class PygameHost:
     def __init__(self, app):
         self.app = app
+        self._q = collections.deque()
+        self._scheduled = False
+        # internal convention: put it in the event __dict__ under the name "thunk"
+        # One marker event is reused since at most one is in flight at a time
+        self._marker = pygame.event.Event(pygame.USEREVENT, thunk=self._drain)
+
+    def _drain(self):
+        """Run every thunk that was queued when the marker event arrived
+
+        Thunks queued while draining post a fresh marker, so a guest that always
+        has more work still lets the main loop handle input between batches.
+        """
+        self._scheduled = False
+        q = self._q
+        for _ in range(len(q)):
+            q.popleft()()
 
     def run_sync_soon_threadsafe(self, func):
-        """Use Pygame/SDL fastevent.post to schedule a function call
+        """Queue a function call, and use Pygame/SDL fastevent.post to wake the main loop
 
         The fastevent library runs a (busy?) loop trying to re-post the events if the
         queue is full, so it can result in deadlocks if called from the main thread.
         In other words, unthreaded unsafe? so we must implement run_sync_soon_not_threadsafe.
+
+        Thunks live in an unbounded deque, and a marker event is only posted when
+        the deque becomes non-empty, so the SDL queue holds at most one of ours.
         """
-        # internal convention: put it in the event __dict__ under the name "thunk"
-        event = pygame.event.Event(pygame.USEREVENT, thunk=func)
-        pygame.fastevent.post(event)
+        self._q.append(func)
+        if not self._scheduled:
+            self._scheduled = True
+            pygame.fastevent.post(self._marker)
 
     def run_sync_soon_not_threadsafe(self, func):
-        """Use Pygame/SDL event.post to schedule a function call
+        """Queue a function call, and use Pygame/SDL event.post to wake the main loop
 
-        The event queue is of finite size so for now we crash hard when that fills.
-        It would be possible to make an unbounded queue for this edge case, or print
-        warnings and continue while losing events, but it seems more prudent to
-        just try to keep the event queue empty.
+        The event queue is of finite size, but since we only ever have one marker
+        event in it, it can't be filled by Trio no matter how many thunks are queued.
 
         Open question: can we use event.post with fastevent? the code seems that way.
 
         raises pygame.error
         """
-        # internal convention: put it in the event __dict__ under the name "thunk"
-        event = pygame.event.Event(pygame.USEREVENT, thunk=func)
-        pygame.event.post(event)
+        self._q.append(func)
+        if not self._scheduled:
+            self._scheduled = True
+            pygame.event.post(self._marker)
 
     def done_callback(self, outcome):
         """non-blocking request to end the main loop
@@ -78,7 +99,13 @@ class PygameDisplay:
         self.screen.blit(cancelsurf, (280, 370))
         self.pbar_rect = pygame.Rect((20, 20), (600, 200))
         self.screen.fill((0, 128, 0), self.pbar_rect)
+        # big enough for the widest label so shorter ones erase longer ones
+        self.percent_rect = pygame.Rect((300, 250), self.font.size('100%'))
+        self._percent_cache = {}  # at most 101 entries, since set_value clamps
+        self._progress_ticks = 0
+        self._percent = None
         self.maximum = 1
+        self.app.mark_dirty()
 
     def set_title(self, title):
         pygame.display.set_caption(title)
@@ -86,12 +113,37 @@ class PygameDisplay:
     def set_max(self, maximum):
         self.maximum = maximum
 
+    def _render_percent(self, percent):
+        try:
+            return self._percent_cache[percent]
+        except KeyError:
+            surf = self.font.render(percent, True, (255,) * 3, (20,) * 3)
+            self._percent_cache[percent] = surf
+            return surf
+
     def set_value(self, downloaded):
-        progress_ticks = 600 * downloaded // self.maximum
-        progress_rect = pygame.Rect((20, 20), (progress_ticks, 200))
-        self.screen.fill((0, 255, 0), progress_rect)
-        percentsurf = self.font.render(str(100 * downloaded // self.maximum) + '%', True, (255,) * 3, (20,) * 3)
-        self.screen.blit(percentsurf, (300, 250))
+        # get() can go past maximum when the body outgrows size_guess, so clamp
+        # to keep the bar and the label inside their rects
+        progress_ticks = min(max(600 * downloaded // self.maximum, 0), 600)
+        if progress_ticks != self._progress_ticks:
+            if progress_ticks < self._progress_ticks:
+                # went backwards, repaint the whole bar
+                self.screen.fill((0, 128, 0), self.pbar_rect)
+                changed = pygame.Rect((20, 20), (progress_ticks, 200))
+                self.app.mark_dirty(self.pbar_rect)
+            else:
+                changed = pygame.Rect(
+                    (20 + self._progress_ticks, 20), (progress_ticks - self._progress_ticks, 200)
+                )
+                self.app.mark_dirty(changed)
+            self.screen.fill((0, 255, 0), changed)
+            self._progress_ticks = progress_ticks
+        percent = str(min(max(100 * downloaded // self.maximum, 0), 100)) + '%'
+        if percent != self._percent:
+            self.screen.fill((30, 30, 30), self.percent_rect)
+            self.screen.blit(self._render_percent(percent), self.percent_rect)
+            self.app.mark_dirty(self.percent_rect)
+            self._percent = percent
 
     def set_cancel(self, fn):
         self.app.register_mouse_cb(fn, self.button_rect)
@@ -100,18 +152,73 @@ class PygameDisplay:
 
 # I know it's rare to put a simple pygame app into a class but I wanted to match the program structure of the others
 class PygameApp:
-    def __init__(self):
+    def __init__(self, idle=False, wait_timeout=1000, fps=None, yield_gil=True):
+        """idle=True blocks in an SDL wait between batches of events instead of
+        busy-polling, waking for input or for a posted Trio thunk. wait_timeout
+        (milliseconds) bounds each wait as a safety net.
+
+        The default busy-polling loop is not a pure spin: each pass ends with
+        time.sleep(0) so the Trio I/O thread can take the GIL, which costs a few
+        tens of microseconds per pass. yield_gil=False makes it a pure spin, for
+        comparison; then the I/O thread waits for the 5 ms switch interval.
+
+        Only regions passed to mark_dirty are sent to the screen. If fps is given,
+        screen updates are held back so they happen at most fps times per second.
+        """
         pygame.display.init()
         pygame.fastevent.init()
         pygame.font.init()
         self.running = False
+        self.idle = idle
+        self.yield_gil = yield_gil
+        self.wait_timeout = wait_timeout
+        self.frame_time = 1 / fps if fps else 0
+        self._next_frame = 0
+        self.dirty_rects = []
+        self._full_redraw = False
         self._mouse_cbs = []
         self._quit_cb = self.quit
 
+    def mark_dirty(self, rect=None):
+        """Queue a screen region for the next update, or the whole screen if rect is None"""
+        if rect is None:
+            self._full_redraw = True
+        else:
+            self.dirty_rects.append(rect)
+
+    def _wait_events(self):
+        events = pygame.fastevent.get()
+        if not events:
+            timeout = self.wait_timeout
+            if self.dirty_rects or self._full_redraw:
+                # don't sleep through a frame that is being held back by the fps cap
+                frame_wait = int((self._next_frame - time.perf_counter()) * 1000) + 1
+                timeout = max(1, min(timeout, frame_wait))
+            event = pygame.event.wait(timeout)
+            if event.type != pygame.NOEVENT:
+                events = [event]
+                events.extend(pygame.fastevent.get())
+        return events
+
+    def _update_screen(self):
+        if not (self.dirty_rects or self._full_redraw):
+            return
+        now = time.perf_counter()
+        if now < self._next_frame:
+            return
+        if self._full_redraw:
+            pygame.display.flip()
+            self._full_redraw = False
+        else:
+            pygame.display.update(self.dirty_rects)
+        self.dirty_rects.clear()
+        self._next_frame = now + self.frame_time
+
     def mainloop(self):
         self.running = True
+        get_events = self._wait_events if self.idle else pygame.fastevent.get
         while self.running:
-            for event in pygame.fastevent.get():
+            for event in get_events():
                 # print(event)
                 if event.type == pygame.QUIT:
                     self._quit_cb()
@@ -119,10 +226,16 @@ class PygameApp:
                     self._mouse_callback(event.pos, event.button)
                 elif event.type == pygame.USEREVENT:
                     event.thunk()  # don't forget to add some ifs here if other USEREVENTS appear
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.mark_dirty()
                 else:
                     pass
                     # print('unused event:', event)
-            pygame.display.flip()
+            self._update_screen()
+            if not self.idle and self.yield_gil:
+                # fastevent.get never releases the GIL, so without this the Trio
+                # I/O thread only gets in at the switch interval (5 ms by default)
+                time.sleep(0)
         pygame.quit()
 
     def _mouse_callback(self, pos, button):
@@ -144,8 +257,8 @@ class PygameApp:
         self.running = False
 
 
-def main(task):
-    app = PygameApp()
+def main(task, idle=False, fps=None):
+    app = PygameApp(idle=idle, fps=fps)
     host = PygameHost(app)
     display = PygameDisplay(app)
     trio.lowlevel.start_guest_run(
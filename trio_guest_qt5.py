@@ -14,23 +14,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import math
 import sys
 import traceback
+from functools import partial
 
-import trio
 # Can't use PySide2 currently because of
 # https://bugreports.qt.io/projects/PYSIDE/issues/PYSIDE-1313
 from PyQt5 import QtCore, QtWidgets
 from outcome import Error
 
+import dashboard
 import example_tasks
+import trio_threadless
 
-# class Reenter(QtCore.QObject):
-#     run = QtCore.Signal(object)
-#
-# This is substantially faster than using a signal... for some reason Qt
-# signal dispatch is really slow (and relies on events underneath anyway, so
-# this is strictly less work)
+# Posting an event should be faster than emitting a queued signal, since Qt
+# signal dispatch relies on events underneath anyway, so this is strictly less
+# work. QtSignalHost below is the signal version: compare the qt5 and
+# qt5-signal rows of python bench_hosts.py --mode throughput.
 REENTER_EVENT_TYPE = QtCore.QEvent.Type(QtCore.QEvent.registerEventType())
 
 
@@ -48,15 +49,31 @@ class QtHost:
     def __init__(self, app):
         self.app = app
         self.reenter = Reenter()
-        # or if using Signal
-        # self.reenter.run.connect(lambda fn: fn(), QtCore.Qt.QueuedConnection)
-        # self.run_sync_soon_threadsafe = self.reenter.run.emit
+        self._waiter = None
 
     def run_sync_soon_threadsafe(self, fn):
         event = ReenterEvent(REENTER_EVENT_TYPE)
         event.fn = fn
         self.app.postEvent(self.reenter, event)
 
+    def wait_readable(self, fd, timeout, callback):
+        """Call callback once fd is readable or timeout expires, for trio_threadless"""
+        notifier = QtCore.QSocketNotifier(fd, QtCore.QSocketNotifier.Read)
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+
+        def fire():
+            notifier.setEnabled(False)
+            timer.stop()
+            callback()
+
+        notifier.activated.connect(fire)
+        timer.timeout.connect(fire)
+        timer.start(max(1, math.ceil(timeout * 1000)))
+        # Keep them alive until the next wait. Dropping them inside fire would
+        # delete the notifier while it is still emitting.
+        self._waiter = notifier, timer
+
     def done_callback(self, outcome):
         print(f"Outcome: {outcome}")
         if isinstance(outcome, Error):
@@ -68,6 +85,22 @@ class QtHost:
         self.app.exec_()
 
 
+class SignalReenter(QtCore.QObject):
+    run = QtCore.pyqtSignal(object)
+
+
+class QtSignalHost(QtHost):
+    """QtHost that reenters through a queued signal instead of a posted event"""
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.signal_reenter = SignalReenter()
+        self.signal_reenter.run.connect(lambda fn: fn(), QtCore.Qt.QueuedConnection)
+
+    def run_sync_soon_threadsafe(self, fn):
+        self.signal_reenter.run.emit(fn)
+
+
 class QtDisplay:
     def __init__(self, app):
         self.app = app
@@ -91,19 +124,54 @@ class QtDisplay:
         self.app.lastWindowClosed.connect(fn)
 
 
-def main(task):
+class QtBoard:
+    """One QTreeWidget row per dashboard task, in a window of its own"""
+
+    def __init__(self, display):
+        self.widget = QtWidgets.QTreeWidget()
+        self.widget.setHeaderLabels(["Task", "State", "Progress"])
+        self.widget.setUniformRowHeights(True)  # lets Qt skip measuring every row
+        self.widget.resize(600, 400)
+        self.widget.show()
+        self.items = []
+
+    def add_rows(self, rows):
+        self.items = [
+            QtWidgets.QTreeWidgetItem([row.title, row.state, row.progress_text()]) for row in rows
+        ]
+        self.widget.addTopLevelItems(self.items)
+
+    def update_rows(self, rows):
+        # Qt coalesces the repaints from all these setText calls into one
+        for row in rows:
+            item = self.items[row.index]
+            item.setText(0, row.title)
+            item.setText(1, row.state)
+            item.setText(2, row.progress_text())
+
+
+def main(task, threadless=False, signal=False):
     app = QtWidgets.QApplication(sys.argv)
     app.setQuitOnLastWindowClosed(False)  # prevent app sudden death
-    host = QtHost(app)
+    host = QtSignalHost(app) if signal else QtHost(app)
     display = QtDisplay(app)
-    trio.lowlevel.start_guest_run(
+    trio_threadless.start_guest_run(
         task,
         display,
         run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
         done_callback=host.done_callback,
+        wait_readable=host.wait_readable if threadless else None,
     )
     host.mainloop()
 
 
+def dashboard_main(tasks, limit=10, threadless=False):
+    """Run many tasks at once, each with a row in a QtBoard"""
+    main(
+        partial(dashboard.run_dashboard, tasks=tasks, make_board=QtBoard, limit=limit),
+        threadless=threadless,
+    )
+
+
 if __name__ == '__main__':
     main(example_tasks.count)
@@ -14,24 +14,149 @@
 # limitations under the License.
 #
 import collections
+import math
+import time
 import tkinter as tk
 import traceback
+from functools import partial
 
-import trio
 from outcome import Error
 
+import dashboard
 import example_tasks
+import trio_threadless
+
+POLICIES = ("count", "fair", "eager", "adaptive")
 
 
 class TkHost:
-    def __init__(self, root):
+    def __init__(
+        self,
+        root,
+        batch=False,
+        budget=100,
+        policy="count",
+        time_budget=0.005,
+        min_time_budget=0.001,
+        max_time_budget=0.05,
+        after=None,
+    ):
+        """Schedule Trio callbacks on a Tk event loop
+
+        With batch=False every thunk gets its own Tcl "after" command. With batch=True
+        a Tcl callback is posted only when the queue goes from empty to non-empty, and
+        each callback drains thunks until the policy says to yield back to Tk:
+
+        - "count": after budget thunks
+        - "fair": after time_budget seconds
+        - "eager": once the queue is empty, or after max_time_budget seconds as a
+          safety net. The rest runs as soon as Tk has no events to handle, so a busy
+          guest gets every moment the GUI doesn't need.
+        - "adaptive": like "fair", but the time budget moves between min_time_budget
+          and max_time_budget. If Tk then takes longer than the budget to get back
+          to us, the GUI is busy, so the budget is halved. Otherwise it grows by a
+          quarter.
+
+        Any policy other than "count" implies batch=True.
+
+        By default threadsafe calls are scheduled with "after idle" and
+        not-threadsafe calls with "after idle after 0". after="idle" or
+        after="idle after 0" uses that one for both, so that bench_hosts can run
+        the same workload each way (the tkinter-after-idle and
+        tkinter-after-idle-0 rows).
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}, not {policy!r}")
         self.root = root
-        self._tk_func_name = root.register(self._tk_func)
         self._q = collections.deque()
+        self.budget = budget
+        self.policy = policy
+        self.time_budget = max_time_budget if policy == "eager" else time_budget
+        self.min_time_budget = min_time_budget
+        self.max_time_budget = max_time_budget
+        self._scheduled = False
+        self._yielded_at = None
+        idle = ('after', 'idle')
+        idle_after_0 = ('after', 'idle', 'after', 0)
+        if after is None:
+            self._threadsafe_after, self._not_threadsafe_after = idle, idle_after_0
+        elif after == "idle":
+            self._threadsafe_after = self._not_threadsafe_after = idle
+        elif after == "idle after 0":
+            self._threadsafe_after = self._not_threadsafe_after = idle_after_0
+        else:
+            raise ValueError(f'after must be None, "idle" or "idle after 0", not {after!r}')
+        if batch or policy != "count":
+            self._tk_func_name = root.register(self._tk_drain)
+            self.run_sync_soon_threadsafe = self._batch_threadsafe
+            self.run_sync_soon_not_threadsafe = self._batch_not_threadsafe
+        else:
+            self._tk_func_name = root.register(self._tk_func)
 
     def _tk_func(self):
         self._q.popleft()()
 
+    def _tk_drain(self):
+        # _scheduled stays True while we drain, so thunks queued meanwhile (by the
+        # guest ticks we run, or from other threads) don't post callbacks of their
+        # own. Only the end of the drain decides whether and how to continue.
+        q = self._q
+        start = time.perf_counter()
+        if self._yielded_at is not None:
+            self._adapt(start - self._yielded_at)
+            self._yielded_at = None
+        try:
+            if self.policy == "count":
+                for _ in range(self.budget):
+                    if not q:
+                        break
+                    q.popleft()()
+            else:
+                deadline = start + self.time_budget
+                while q:
+                    q.popleft()()
+                    if time.perf_counter() >= deadline:
+                        break
+        finally:
+            # Clear the flag before checking the queue, so a thunk appended from
+            # another thread just before this is either seen below or schedules a
+            # fresh callback. Worst case is a spurious extra callback.
+            self._scheduled = False
+            if q and not self._scheduled:
+                # Over budget: let the Tk event queue breathe before continuing
+                self._scheduled = True
+                if self.policy == "eager":
+                    self.root.call('after', 'idle', self._tk_func_name)
+                else:
+                    if self.policy == "adaptive":
+                        self._yielded_at = time.perf_counter()
+                    self.root.call('after', 'idle', 'after', 0, self._tk_func_name)
+
+    def _adapt(self, gui_time):
+        """Shrink the time budget if the GUI kept us waiting, else grow it"""
+        if gui_time > self.time_budget:
+            self.time_budget = max(self.min_time_budget, self.time_budget / 2)
+        else:
+            self.time_budget = min(self.max_time_budget, self.time_budget * 1.25)
+
+    def _batch_threadsafe(self, func):
+        """Batched version of run_sync_soon_threadsafe
+
+        Only the empty -> non-empty transition costs a Tcl call (and a trip
+        through Tkapp_ThreadSend when called from another thread).
+        """
+        self._q.append(func)
+        if not self._scheduled:
+            self._scheduled = True
+            self.root.call(*self._threadsafe_after, self._tk_func_name)
+
+    def _batch_not_threadsafe(self, func):
+        """Batched version of run_sync_soon_not_threadsafe"""
+        self._q.append(func)
+        if not self._scheduled:
+            self._scheduled = True
+            self.root.call(*self._not_threadsafe_after, self._tk_func_name)
+
     def run_sync_soon_threadsafe(self, func):
         """Use Tcl "after" command to schedule a function call
 
@@ -40,7 +165,9 @@ class TkHost:
         to the `appropriate thread <https://github.com/python/cpython/blob/a5d6aba318ead9cc756ba750a70da41f5def3f8f/Modules/_tkinter.c#L814-L824>`_ on line 1522.
         Tkapp_ThreadSend effectively uses "after 0" while putting the command in the
         event queue so the `"after idle after 0" <https://wiki.tcl-lang.org/page/after#096aeab6629eae8b244ae2eb2000869fbe377fa988d192db5cf63defd3d8c061>`_ incantation
-        is unnecessary here.
+        should be unnecessary here. To check, compare the pongs/s of the
+        tkinter-after-idle and tkinter-after-idle-0 rows of
+        ``python bench_hosts.py --mode throughput``.
 
         Compare to `tkthread <https://github.com/serwy/tkthread/blob/1f612e1dd46e770bd0d0bb64d7ecb6a0f04875a3/tkthread/__init__.py#L163>`_
         where definitely thread unsafe `eval <https://github.com/python/cpython/blob/a5d6aba318ead9cc756ba750a70da41f5def3f8f/Modules/_tkinter.c#L1567-L1585>`_
@@ -48,7 +175,7 @@ class TkHost:
         """
         # self.root.after_idle(lambda:self.root.after(0, func)) # does a fairly intensive wrapping to each func
         self._q.append(func)
-        self.root.call('after', 'idle', self._tk_func_name)
+        self.root.call(*self._threadsafe_after, self._tk_func_name)
 
     def run_sync_soon_not_threadsafe(self, func):
         """Use Tcl "after" command to schedule a function call from the main thread
@@ -58,14 +185,35 @@ class TkHost:
 
         The incantation `"after idle after 0" <https://wiki.tcl-lang.org/page/after#096aeab6629eae8b244ae2eb2000869fbe377fa988d192db5cf63defd3d8c061>`_ avoids blocking the normal event queue when
         faced with an unending stream of tasks, for example "while True: await trio.sleep(0)".
+        The ticks/s of the tkinter-after-idle and tkinter-after-idle-0 rows of
+        ``python bench_hosts.py --mode throughput`` show what it costs.
         """
         self._q.append(func)
-        self.root.call('after', 'idle', 'after', 0, self._tk_func_name)
+        self.root.call(*self._not_threadsafe_after, self._tk_func_name)
         # Not sure if this is actually an optimization because Tcl parses this eval string fresh each time.
         # However it's definitely thread unsafe because the string is fed directly into the Tcl interpreter
         # from the current Python thread
         # self.root.eval(f'after idle after 0 {self._tk_func_name}')
 
+    def wait_readable(self, fd, timeout, callback):
+        """Call callback once fd is readable or timeout expires, for trio_threadless
+
+        Tcl file handlers are only available on Unix, which is also the only place
+        Trio's I/O backend has a pollable fd.
+        """
+
+        def on_fd(file, mask):
+            self.root.after_cancel(timer)
+            self.root.deletefilehandler(fd)
+            callback()
+
+        def on_timeout():
+            self.root.deletefilehandler(fd)
+            callback()
+
+        self.root.createfilehandler(fd, tk.READABLE, on_fd)
+        timer = self.root.after(max(1, math.ceil(timeout * 1000)), on_timeout)
+
     def done_callback(self, outcome):
         """End the Tk app.
         """
@@ -105,19 +253,68 @@ class TkDisplay:
         self.master.protocol("WM_DELETE_WINDOW", fn)  # calls .destroy() by default
 
 
-def main(task):
+class TkBoard:
+    """One ttk.Treeview row per dashboard task, above the overall progress bar
+
+    Select rows and press Delete to cancel them.
+    """
+
+    def __init__(self, display):
+        import tkinter.ttk as ttk
+
+        master = display.master
+        frame = tk.Frame(master)
+        self.tree = ttk.Treeview(frame, columns=('state', 'progress'), height=15)
+        self.tree.heading('#0', text='Task')
+        self.tree.heading('state', text='State')
+        self.tree.heading('progress', text='Progress')
+        scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(fill=tk.BOTH, expand=1)
+        frame.pack(before=display.progress, fill=tk.BOTH, expand=1)
+        self.tree.bind('<Delete>', self._cancel_selected)
+        self.rows = {}
+
+    def add_rows(self, rows):
+        for row in rows:
+            iid = str(row.index)
+            self.rows[iid] = row
+            self.tree.insert('', tk.END, iid, text=row.title, values=(row.state, row.progress_text()))
+
+    def update_rows(self, rows):
+        for row in rows:
+            self.tree.item(str(row.index), text=row.title, values=(row.state, row.progress_text()))
+
+    def _cancel_selected(self, event):
+        for iid in self.tree.selection():
+            self.rows[iid].cancel()
+
+
+def main(task, batch=False, threadless=False, policy="count", after=None):
     root = tk.Tk()
-    host = TkHost(root)
+    host = TkHost(root, batch=batch, policy=policy, after=after)
     display = TkDisplay(root)
-    trio.lowlevel.start_guest_run(
+    trio_threadless.start_guest_run(
         task,
         display,
         run_sync_soon_threadsafe=host.run_sync_soon_threadsafe,
         run_sync_soon_not_threadsafe=host.run_sync_soon_not_threadsafe,
         done_callback=host.done_callback,
+        wait_readable=host.wait_readable if threadless else None,
     )
     host.mainloop()
 
 
+def dashboard_main(tasks, limit=10, batch=True, threadless=False, policy="count"):
+    """Run many tasks at once, each with a row in a TkBoard"""
+    main(
+        partial(dashboard.run_dashboard, tasks=tasks, make_board=TkBoard, limit=limit),
+        batch=batch,
+        threadless=threadless,
+        policy=policy,
+    )
+
+
 if __name__ == '__main__':
     main(example_tasks.count)
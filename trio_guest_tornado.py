@@ -27,7 +27,6 @@ import tornado.concurrent
 from outcome import Error
 
 import example_tasks
-import tqdm
 
 
 class TornadoHost:
@@ -48,6 +47,8 @@ class TornadoHost:
 
 class TqdmDisplay:
     def __init__(self):
+        import tqdm
+
         self.pbar = tqdm.tqdm(unit='Bytes', unit_scale=1)
         self.prev_downloaded = 0
 
@@ -0,0 +1,143 @@
+#
+# Copyright 2020 Richard J. Sheridan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+""" Run Trio in guest mode without the I/O thread
+
+Normally, when the guest has nothing to do, Trio blocks in its I/O backend
+(epoll or kqueue) on a worker thread, which then wakes the host with
+run_sync_soon_threadsafe. But an epoll or kqueue fd is itself pollable, so the
+host loop can watch it directly and we can skip the thread and the cross-thread
+wakeup entirely.
+
+The host provides wait_readable(fd, timeout, callback), which must call
+callback() exactly once, on the host thread, as soon as fd is readable or
+timeout seconds have passed, whichever comes first.
+
+This reaches into Trio internals. We replace start_thread_soon in
+trio._core._run and pick apart the get_events closure that
+GuestState.guest_tick hands it, which closes over (self, timeout). Written
+and tested against Trio 0.22.x. The first threadless start_guest_run checks
+that this Trio still has that shape. If it doesn't, the run falls back to the
+normal threaded path with a RuntimeWarning saying why. A backend without a
+pollable fd, such as Windows IOCP, also uses the threaded path.
+"""
+import warnings
+
+import outcome
+import trio
+import trio._core._run
+
+_threaded_start_thread_soon = trio._core._run.start_thread_soon
+# run_sync_soon_threadsafe of each threadless guest -> host's wait_readable
+_wait_readable_by_guest = {}
+# code of the get_events closure in GuestState.guest_tick, once checked
+_get_events_code = None
+
+
+def _find_get_events_code():
+    """Check Trio's guest internals look as we expect, and return get_events' code
+
+    Raises RuntimeError saying what doesn't match.
+    """
+    guest_state = getattr(trio._core._run, "GuestState", None)
+    guest_tick = getattr(guest_state, "guest_tick", None)
+    if guest_tick is None or not hasattr(trio._core._run, "start_thread_soon"):
+        raise RuntimeError("trio._core._run has no GuestState.guest_tick or start_thread_soon")
+    fields = {field.name for field in getattr(guest_state, "__attrs_attrs__", ())}
+    if not {"runner", "run_sync_soon_threadsafe"} <= fields:
+        raise RuntimeError(f"GuestState has fields {sorted(fields)}")
+    for const in guest_tick.__code__.co_consts:
+        if getattr(const, "co_name", None) == "get_events":
+            if const.co_freevars != ("self", "timeout"):
+                raise RuntimeError(f"get_events closes over {const.co_freevars}")
+            return const
+    raise RuntimeError("GuestState.guest_tick has no get_events closure")
+
+
+def _install():
+    global _get_events_code
+    if _get_events_code is None:
+        _get_events_code = _find_get_events_code()
+        trio._core._run.start_thread_soon = _threadless_start_thread_soon
+
+
+def _pollable_fd(io_manager):
+    for name in ("_epoll", "_kqueue"):
+        poller = getattr(io_manager, name, None)
+        if poller is not None:
+            return poller.fileno()
+    return None
+
+
+def _threadless_start_thread_soon(fn, deliver, *args, **kwargs):
+    """Stand-in for start_thread_soon in trio._core._run
+
+    GuestState.guest_tick calls this with a get_events closure over the guest
+    state and the timeout, as checked by _install. For threadless guests we
+    arrange for the host to poll Trio's fd instead, then collect the events
+    without blocking.
+    """
+    if getattr(fn, "__code__", None) is _get_events_code:
+        guest, timeout = (cell.cell_contents for cell in fn.__closure__)
+        wait_readable = _wait_readable_by_guest.get(guest.run_sync_soon_threadsafe)
+        if wait_readable is not None:
+            io_manager = guest.runner.io_manager
+            fd = _pollable_fd(io_manager)
+            if fd is not None:
+
+                def ready():
+                    deliver(outcome.capture(io_manager.get_events, 0))
+
+                wait_readable(fd, timeout, ready)
+                return
+    _threaded_start_thread_soon(fn, deliver, *args, **kwargs)
+
+
+def start_guest_run(
+    async_fn, *args, run_sync_soon_threadsafe, done_callback, wait_readable=None, **kwargs
+):
+    """Like trio.lowlevel.start_guest_run, but without the I/O thread if possible
+
+    If wait_readable is None this is exactly trio.lowlevel.start_guest_run.
+    """
+    if wait_readable is not None:
+        try:
+            _install()
+        except RuntimeError as exc:
+            warnings.warn(
+                f"trio_threadless doesn't support Trio {trio.__version__} ({exc}),"
+                " using the I/O thread",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+        else:
+            _wait_readable_by_guest[run_sync_soon_threadsafe] = wait_readable
+            user_done_callback = done_callback
+
+            def done_callback(outcome):
+                _wait_readable_by_guest.pop(run_sync_soon_threadsafe, None)
+                user_done_callback(outcome)
+
+    try:
+        return trio.lowlevel.start_guest_run(
+            async_fn,
+            *args,
+            run_sync_soon_threadsafe=run_sync_soon_threadsafe,
+            done_callback=done_callback,
+            **kwargs,
+        )
+    except BaseException:
+        _wait_readable_by_guest.pop(run_sync_soon_threadsafe, None)
+        raise